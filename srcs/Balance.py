@@ -2,16 +2,18 @@
 
 import os
 import random
+import numpy as np
 import matplotlib.image as mplimg
 
 from tqdm import tqdm
 from utils.ArgsHandler import ArgsHandler, ArgsObject, OptionObject
 from utils.ArgsHandler import display_helper
 
-from utils.data_augmentation import image_flip, image_rotate, image_skew
-from utils.data_augmentation import image_shear, image_crop, image_distortion
-from utils.data_augmentation import image_blur, image_brightness
-from utils.data_augmentation import image_contrast, image_projective
+from utils.data_augmentation import BATCH_AUGMENTATIONS, to_uint8
+
+
+# Number of images augmented together
+BATCH_SIZE = 32
 
 
 def check_transformation(args_handler, u_ipt):
@@ -69,10 +71,14 @@ def get_max_size(path: str, depth: int) -> list:
         return all_path
 
 
-def get_allowed_transfo(img_path: str, allowed_transfo: list) -> str:
-    """Get a random transformation not currently existing in the folder"""
+def get_allowed_transfo(img_path: str, allowed_transfo: list,
+                        planned: set = None) -> str:
+    """Get a random transformation not currently existing in the folder
+    nor already planned"""
     valid = []
     for transfo in allowed_transfo:
+        if planned is not None and (img_path, transfo) in planned:
+            continue
         if not os.path.exists(f"{img_path[:-4]}_{transfo.capitalize()}.JPG"):
             valid.append(transfo)
     if len(valid) == 0:
@@ -80,46 +86,69 @@ def get_allowed_transfo(img_path: str, allowed_transfo: list) -> str:
     return valid[random.randint(0, len(valid) - 1)]
 
 
-def balance_data(all_path: dict, max_size: int, allowed_transfo: list):
-    """Balance image in all folder to reach the amount of max_size
-    Image are balanceed with augmentation function"""
-    augmentation = {
-        'flip': image_flip,
-        'rotate': image_rotate,
-        'skew': image_skew,
-        'shear': image_shear,
-        'crop': image_crop,
-        'distortion': image_distortion,
-        'blur': image_blur,
-        'brightness': image_brightness,
-        'contrast': image_contrast,
-        'projective': image_projective
-    }
-    for key, value in all_path.items():
-        print(f"Balance folder {key}")
-        list_file = os.listdir(key)
-        for _ in tqdm(range(max_size - value)):
-            aug_use = None
-            while aug_use is None and len(list_file) > 0:
-                rimg = random.choice(list_file)
-                img_path = f"{key}/{rimg}"
-
-                aug_use = get_allowed_transfo(img_path, allowed_transfo)
-                if aug_use is None:
-                    list_file.remove(rimg)
+def plan_augmentations(folder: str, missing: int,
+                       allowed_transfo: list) -> list:
+    """Choose up to missing (image path, transformation) pairs to add
+    in folder"""
+    list_file = os.listdir(folder)
+    tasks, planned = [], set()
+    for _ in range(missing):
+        aug_use = None
+        while aug_use is None and len(list_file) > 0:
+            rimg = random.choice(list_file)
+            img_path = f"{folder}/{rimg}"
+
+            aug_use = get_allowed_transfo(img_path, allowed_transfo, planned)
             if aug_use is None:
-                break
+                list_file.remove(rimg)
+        if aug_use is None:
+            break
+        tasks.append((img_path, aug_use))
+        planned.add((img_path, aug_use))
+    return tasks
 
-            transfo = augmentation[aug_use]
 
-            img = mplimg.imread(img_path)
-            new_img = transfo(img)
+def save_augmentation(img_path: str, aug_use: str, new_img: np.ndarray):
+    """Save the augmented image next to its source"""
+    root, ext = os.path.splitext(img_path)
+    try:
+        mplimg.imsave(f"{root}_{aug_use.capitalize()}{ext}", new_img)
+    except Exception as e:
+        print(f"Error while saving {img_path} transformation: {e}")
+
+
+def augment_files(tasks: list, batch_size: int = BATCH_SIZE):
+    """Apply the (image path, transformation) tasks by batches of images
+    sharing a transformation and a shape"""
+    by_transfo = {}
+    for img_path, aug_use in tasks:
+        by_transfo.setdefault(aug_use, []).append(img_path)
+
+    with tqdm(total=len(tasks)) as progress:
+        for aug_use, paths in by_transfo.items():
+            for i in range(0, len(paths), batch_size):
+                by_shape = {}
+                for img_path in paths[i:i + batch_size]:
+                    img = to_uint8(mplimg.imread(img_path))
+                    by_shape.setdefault(img.shape, []).append((img_path, img))
+
+                for shape, items in by_shape.items():
+                    batch = np.stack([img.reshape(*shape[:2], -1)
+                                      for _, img in items])
+                    new_imgs = BATCH_AUGMENTATIONS[aug_use](batch)
+                    for (img_path, _), new_img in zip(items, new_imgs):
+                        save_augmentation(img_path, aug_use,
+                                          new_img.reshape(shape))
+                progress.update(len(paths[i:i + batch_size]))
 
-            root, ext = os.path.splitext(img_path)
-            try:
-                mplimg.imsave(f"{root}_{aug_use.capitalize()}{ext}", new_img)
-            except Exception as e:
-                print(f"Error while saving {key} transformation: {e}")
+
+def balance_data(all_path: dict, max_size: int, allowed_transfo: list):
+    """Balance image in all folder to reach the amount of max_size
+    Image are balanceed with augmentation function, applied by batches"""
+    for key, value in all_path.items():
+        print(f"Balance folder {key}")
+        augment_files(plan_augmentations(key, max_size - value,
+                                         allowed_transfo))
 
 
 def clear_data(all_path: dict, clear_transfo: list):
@@ -0,0 +1,214 @@
+#!/bin/env python3
+
+import time
+import rembg
+import numpy as np
+import matplotlib.image as mplimg
+
+from utils.ArgsHandler import ArgsHandler, ArgsObject, OptionObject
+from utils.ArgsHandler import display_helper
+
+from utils.image_loader import list_image_files
+from utils.data_transformation import get_rembg_session
+from utils.data_transformation import rembg_predict_batch
+from utils.data_transformation import REMBG_MODELS
+from utils.data_transformation import check_rembg_model, check_background_mode
+from utils.transformation_context import TransformationContext
+
+
+def time_per_image(function, images: list) -> float:
+    """Return the mean milliseconds function takes on one image"""
+    start = time.perf_counter()
+    for img in images:
+        function(img)
+    return (time.perf_counter() - start) * 1000 / len(images)
+
+
+def bench_rembg_session(images: list, user_input: dict) -> None:
+    """Compare a new rembg session per image with the shared session"""
+    model_name = user_input['rembg-model']
+    get_rembg_session(model_name)
+
+    fresh = time_per_image(lambda img: rembg.remove(
+        img, session=rembg.new_session(model_name)), images)
+    shared = time_per_image(lambda img: rembg.remove(
+        img, session=get_rembg_session(model_name)), images)
+
+    print(f"new session per image: {fresh:.1f}ms/image")
+    print(f"shared session:        {shared:.1f}ms/image")
+    print(f"speedup:               {fresh / shared:.2f}x")
+
+
+def mask_iou(mask_a: np.ndarray, mask_b: np.ndarray) -> float:
+    """Intersection over union of two binary masks"""
+    a, b = mask_a > 0, mask_b > 0
+    union = np.count_nonzero(a | b)
+    return np.count_nonzero(a & b) / union if union else 1.0
+
+
+def bench_background_iou(images: list, user_input: dict) -> None:
+    """Compare the fast background mask with the rembg one"""
+    model_name = user_input['rembg-model']
+    get_rembg_session(model_name)
+
+    masks = {}
+    for mode in ('quality', 'fast'):
+        masks[mode] = []
+        elapsed = time_per_image(lambda img: masks[mode].append(
+            TransformationContext(img, model_name, mode).background_mask),
+            images)
+        print(f"{mode + ':':9}{elapsed:.1f}ms/image")
+
+    ious = np.array([mask_iou(quality, fast) for quality, fast
+                     in zip(masks['quality'], masks['fast'])])
+    print(f"IoU fast vs rembg: mean {ious.mean():.3f}, \
+p5 {np.percentile(ious, 5):.3f}, min {ious.min():.3f}")
+
+
+def bench_rembg_batch(images: list, user_input: dict) -> None:
+    """Throughput of rembg scoring the images by batches of 1 to 16"""
+    model_name = user_input['rembg-model']
+    rembg_predict_batch(images[:1], model_name)
+
+    for batch_size in (1, 4, 8, 16):
+        start = time.perf_counter()
+        for i in range(0, len(images), batch_size):
+            rembg_predict_batch(images[i:i + batch_size], model_name)
+        elapsed = time.perf_counter() - start
+        print(f"batch {batch_size:2}: {len(images) / elapsed:.2f} images/s")
+
+
+def bench_batch_iou(images: list, user_input: dict) -> None:
+    """Check, for every rembg model, that the masks of
+    rembg_predict_batch are those of rembg.remove"""
+    for model_name in REMBG_MODELS:
+        session = get_rembg_session(model_name)
+        batched = rembg_predict_batch(images, model_name)
+        ious, diffs = [], []
+        for img, mask in zip(images, batched):
+            reference = np.asarray(rembg.remove(img, session=session,
+                                                only_mask=True))
+            mask = np.asarray(mask)
+            ious.append(mask_iou(mask > 127, reference > 127))
+            diffs.append(np.abs(mask.astype(np.int16) - reference).max())
+        print(f"{model_name + ':':19}IoU mean {np.mean(ious):.4f}, \
+min {np.min(ious):.4f}, max pixel difference {np.max(diffs)}")
+
+
+def bench_mask_scale(images: list, user_input: dict) -> None:
+    """Time the background and disease masks computed on the images
+    resized by 1/2 and 1/4, and their IoU with the full size masks"""
+    options = {'model_name': user_input['rembg-model'],
+               'background_mode': user_input['background-mode']}
+    get_rembg_session(options['model_name'])
+
+    masks = {}
+    for scale, refine in ((1.0, False), (0.5, False), (0.5, True),
+                          (0.25, False), (0.25, True)):
+        contexts = [TransformationContext(img, scale=scale, refine=refine,
+                                          **options) for img in images]
+        elapsed = time_per_image(lambda context: context.disease_mask,
+                                 contexts)
+        masks[scale, refine] = contexts
+        line = f"scale {scale:<4}{' refined' if refine else '        '}: \
+{elapsed:.1f}ms/image"
+        if scale < 1:
+            for name in ('background_mask', 'disease_mask'):
+                ious = [mask_iou(getattr(full, name), getattr(small, name))
+                        for full, small in zip(masks[1.0, False], contexts)]
+                line += f", {name.split('_')[0]} IoU {np.mean(ious):.3f}"
+        print(line)
+
+
+BENCHMARKS = {
+    'rembg-session': bench_rembg_session,
+    'background-iou': bench_background_iou,
+    'rembg-batch': bench_rembg_batch,
+    'batch-iou': bench_batch_iou,
+    'mask-scale': bench_mask_scale,
+}
+
+
+def check_benchmark(args_handler, u_ipt):
+    """Check the benchmark asked by the user"""
+    if u_ipt['benchmark'] not in BENCHMARKS:
+        raise ValueError(f"Benchmarks are {', '.join(BENCHMARKS)} \
+not {u_ipt['benchmark']}")
+    return u_ipt
+
+
+def main():
+    """Main"""
+    args_handler = ArgsHandler(
+        'This program take a path as arguments and time the image \
+transformations on a sample of its images',
+        [
+            ArgsObject('folder_path', 'The path of the targeted folder')
+        ],
+        [
+            OptionObject('help', 'Show this help message',
+                         name='h',
+                         expected_type=bool,
+                         default=False,
+                         check_function=display_helper
+                         ),
+            OptionObject('benchmark', 'The benchmark to run',
+                         name='b',
+                         expected_type=str,
+                         default='rembg-session',
+                         check_function=check_benchmark
+                         ),
+            OptionObject('number', 'The number of sampled images',
+                         name='n',
+                         expected_type=int,
+                         default=20,
+                         ),
+            OptionObject('rembg-model', 'The rembg model segmenting the \
+background',
+                         name='rm',
+                         expected_type=str,
+                         default='u2net',
+                         check_function=check_rembg_model
+                         ),
+            OptionObject('background-mode', 'The background mode of the \
+mask-scale benchmark, quality or fast',
+                         name='bm',
+                         expected_type=str,
+                         default='quality',
+                         check_function=check_background_mode
+                         ),
+        ],
+        f"""Benchmarks: {', '.join(BENCHMARKS)}\n"""
+    )
+
+    try:
+        user_input = args_handler.parse_args()
+        args_handler.check_args(user_input)
+    except SystemExit:
+        return
+    except Exception as e:
+        print(e)
+        return
+
+    try:
+        paths = list_image_files(user_input['args'][0])
+        if not paths:
+            raise ValueError(f"No image in {user_input['args'][0]}")
+        rng = np.random.default_rng(0)
+        sample = rng.choice(len(paths),
+                            min(user_input['number'], len(paths)),
+                            replace=False)
+        images = [mplimg.imread(paths[i]) for i in sorted(sample)]
+    except Exception as e:
+        print(e)
+        return
+
+    print(f"{user_input['benchmark']} on {len(images)} images")
+    try:
+        BENCHMARKS[user_input['benchmark']](images, user_input)
+    except Exception as e:
+        print(f"Error while benchmarking: {e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+#!/bin/env python3
+
+import os
+import json
+import multiprocessing
+
+from utils.ArgsHandler import ArgsHandler, ArgsObject, OptionObject
+from utils.ArgsHandler import display_helper
+
+from utils.image_loader import list_image_labels
+from utils.data_transformation import check_rembg_model
+from utils.feature_extraction import FeatureWriter, FEATURE_FORMATS
+from utils.feature_extraction import init_worker, extract_task, feature_names
+
+
+def check_format(args_handler, u_ipt):
+    """Check the file format asked by the user"""
+    if u_ipt['format'] not in FEATURE_FORMATS:
+        raise ValueError(f"Formats are {', '.join(FEATURE_FORMATS)} \
+not {u_ipt['format']}")
+    return u_ipt
+
+
+def extract_folder(path, depth, writer, workers, model_name):
+    """Extract the features of the images of the class folders on a pool
+    of workers and give the rows to writer as they come.
+    Return the class names and the number of images in error"""
+    names, paths, labels = list_image_labels(path, depth)
+    tasks = ((i, p, model_name) for i, p in enumerate(paths))
+    errors = 0
+    with multiprocessing.Pool(workers, initializer=init_worker) as pool:
+        for done, (i, features, error) in enumerate(
+                pool.imap(extract_task, tasks, chunksize=4), 1):
+            if error is not None:
+                print(f"Error on {paths[i]}: {error}")
+                errors += 1
+            else:
+                writer.add(paths[i], names[labels[i]], features)
+            if done % writer.shard_size == 0:
+                print(f"{done}/{len(paths)} images done")
+    writer.flush()
+    return names, errors
+
+
+def main():
+    """Main"""
+    args_handler = ArgsHandler(
+        'This program take a path as arguments and extract the mask area, \
+pseudolandmarks and color histograms of its images in a feature dataset',
+        [
+            ArgsObject('folder_path', 'The path of the targeted folder')
+        ],
+        [
+            OptionObject('help', 'Show this help message',
+                         name='h',
+                         expected_type=bool,
+                         default=False,
+                         check_function=display_helper
+                         ),
+            OptionObject('depth', 'The folder depth of the classes',
+                         name='d',
+                         expected_type=int,
+                         default=1,
+                         ),
+            OptionObject('output', 'The folder of the feature files',
+                         name='o',
+                         expected_type=str,
+                         default='features',
+                         ),
+            OptionObject('format', 'The format of the feature files, npz \
+or parquet',
+                         name='f',
+                         expected_type=str,
+                         default='npz',
+                         check_function=check_format
+                         ),
+            OptionObject('shard-size', 'The number of images per file',
+                         name='s',
+                         expected_type=int,
+                         default=1000,
+                         ),
+            OptionObject('workers', 'The number of processes extracting \
+the features',
+                         name='j',
+                         expected_type=int,
+                         default=os.cpu_count()),
+            OptionObject('rembg-model', 'The rembg model segmenting the \
+background',
+                         name='rm',
+                         expected_type=str,
+                         default='u2net',
+                         check_function=check_rembg_model
+                         ),
+        ],
+        """Each file holds the path, label, area, x_landmarks, y_landmarks \
+and histograms columns of its images
+"""
+    )
+
+    try:
+        user_input = args_handler.parse_args()
+        args_handler.check_args(user_input)
+    except SystemExit:
+        return
+    except Exception as e:
+        print(e)
+        return
+
+    try:
+        writer = FeatureWriter(user_input['output'],
+                               user_input['shard-size'],
+                               user_input['format'])
+        names, errors = extract_folder(user_input['args'][0],
+                                       user_input['depth'],
+                                       writer,
+                                       user_input['workers'],
+                                       user_input['rembg-model'])
+    except KeyboardInterrupt:
+        print("Interrupted by user")
+        return
+    except Exception as e:
+        print(f"Error while extracting features: {e}")
+        return
+
+    with open(os.path.join(user_input['output'], 'features.json'), 'w') as f:
+        json.dump({'labels': names,
+                   'features': feature_names(),
+                   'shards': [os.path.basename(s) for s in writer.shards]},
+                  f, indent=4)
+    print(f"Features written in {len(writer.shards)} files in \
+{user_input['output']}, {errors} images in error")
+
+
+if __name__ == "__main__":
+    main()
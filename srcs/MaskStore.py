@@ -0,0 +1,87 @@
+#!/bin/env python3
+
+import os
+
+from utils.ArgsHandler import ArgsHandler, ArgsObject, OptionObject
+from utils.ArgsHandler import display_helper
+
+from utils.mask_store import MaskStore, MASK_VERSION
+
+
+def main():
+    """Main"""
+    args_handler = ArgsHandler(
+        'This program take a mask store as arguments and remove its stale \
+masks: those of an older mask version, those not used for some days and \
+the least recently used ones above a size',
+        [
+            ArgsObject('store_path', 'The path of the mask store')
+        ],
+        [
+            OptionObject('help', 'Show this help message',
+                         name='h',
+                         expected_type=bool,
+                         default=False,
+                         check_function=display_helper
+                         ),
+            OptionObject('days', 'Remove the masks not used for this \
+number of days',
+                         name='d',
+                         expected_type=int,
+                         default=None
+                         ),
+            OptionObject('max-size', 'Evict the least recently used masks \
+above this size in MB',
+                         name='s',
+                         expected_type=int,
+                         default=None
+                         ),
+            OptionObject('stats', 'Only display the masks stored per model',
+                         name='st',
+                         expected_type=bool,
+                         default=False
+                         ),
+        ],
+        """"""
+    )
+
+    try:
+        user_input = args_handler.parse_args()
+        args_handler.check_args(user_input)
+    except SystemExit:
+        return
+    except Exception as e:
+        print(e)
+        return
+
+    path = user_input['args'][0]
+    if not os.path.isfile(path):
+        print(f"No mask store at {path}")
+        return
+
+    try:
+        store = MaskStore(path)
+    except Exception as e:
+        print(e)
+        return
+
+    try:
+        if not user_input['stats']:
+            models = [model for model in store.stats()
+                      if model.startswith(f"v{MASK_VERSION}:")]
+            days = user_input.get('days')
+            removed = store.prune(models,
+                                  None if days is None else days * 86400)
+            if user_input.get('max-size') is not None:
+                removed += store.evict(user_input['max-size'] << 20)
+            store.vacuum()
+            print(f"{removed} masks removed")
+        for model, stats in store.stats().items():
+            print(f"{model}: {stats['masks']} masks, \
+{stats['bytes'] / (1 << 20):.1f}MB")
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+#!/bin/env python3
+
+import os
+
+from utils.ArgsHandler import ArgsHandler, ArgsObject, OptionObject
+from utils.ArgsHandler import display_helper
+
+from utils.data_cache import pack_dataset
+
+
+def main():
+    """Main"""
+    args_handler = ArgsHandler(
+        'This program take a path as arguments and pack the decoded \
+images in a memory-mapped cache used by train.py --cache',
+        [
+            ArgsObject('folder_path', 'The path of the targeted folder')
+        ],
+        [
+            OptionObject('help', 'Show this help message',
+                         name='h',
+                         expected_type=bool,
+                         default=False,
+                         check_function=display_helper
+                         ),
+            OptionObject('depth', 'The folder depth of the classes',
+                         name='d',
+                         expected_type=int,
+                         default=1,
+                         ),
+            OptionObject('cache', 'The cache folder',
+                         name='c',
+                         expected_type=str,
+                         default='dataset_cache',
+                         ),
+            OptionObject('workers', 'The number of processes decoding \
+the images',
+                         name='j',
+                         expected_type=int,
+                         default=os.cpu_count())
+        ],
+        """Only new or modified files are decoded again\n"""
+    )
+
+    try:
+        user_input = args_handler.parse_args()
+        args_handler.check_args(user_input)
+    except SystemExit:
+        return
+    except Exception as e:
+        print(e)
+        return
+
+    try:
+        index = pack_dataset(user_input['args'][0],
+                             user_input['depth'],
+                             user_input['cache'],
+                             user_input['workers'])
+    except Exception as e:
+        print(f"Error while packing data: {e}")
+        return
+
+    print(f"{len(index['files'])} images in {len(index['labels'])} \
+classes packed in {user_input['cache']}")
+
+
+if __name__ == "__main__":
+    main()
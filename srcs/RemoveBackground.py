@@ -1,36 +1,314 @@
 #!/bin/env python3
 
 import os
+import time
+import collections
+import multiprocessing
+import numpy as np
 import matplotlib.image as mplimg
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
 
 from utils.ArgsHandler import ArgsHandler, ArgsObject, OptionObject
 from utils.ArgsHandler import display_helper
 
-from utils.data_transformation import imgt_mask_background
 from utils.data_transformation import imgt_clear_background
+from utils.data_transformation import check_rembg_model, check_scale
+from utils.data_transformation import check_background_mode
+from utils.transformation_context import TransformationContext
+from utils.transformation_context import compute_background_masks
+from utils.mask_store import MaskStore
+from utils.manifest import Manifest
+from utils.image_loader import list_image_files
+from utils.hashing import file_digest
 
 
-def remove_background(path: str, destination: str) -> list:
-    """Get the max folder size at depth from path"""
-
-    with os.scandir(path) as it:
-        for entry in it:
-            if entry.is_file():
-                try:
-                    img = mplimg.imread(entry.path)
-                    background_mask = imgt_mask_background(img)
-                    img_c = imgt_clear_background(img, background_mask)
-                    mplimg.imsave(os.path.join(destination, entry.name), img_c)
-                    print(f"Image {destination}/{entry.name} Done")
-                except Exception as e:
-                    print(f"Error: {e}")
-                    continue
-            elif entry.is_dir():
-                next_destination = os.path.join(destination, entry.name)
-                if not os.path.exists(next_destination):
-                    os.makedirs(next_destination)
-                remove_background(entry.path, next_destination)
-        return
+# State of a --workers process, set by init_worker
+_worker = {}
+
+# Models whose batch segmentation failed, reported once per process
+_batch_failures = set()
+
+
+def read_file(file: str) -> tuple:
+    """Read an image and hash its file, timing it"""
+    start = time.perf_counter()
+    img = mplimg.imread(file)
+    digest = file_digest(file)
+    return img, digest, time.perf_counter() - start
+
+
+def write_file(output: str, img: np.ndarray) -> float:
+    """Encode an image in output, timing it"""
+    start = time.perf_counter()
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    mplimg.imsave(output, img)
+    return time.perf_counter() - start
+
+
+def clear_background_batch(images: list, mask_options: dict) -> list:
+    """Remove the background of a batch of (file, image, digest), running
+    rembg on the batch at once. mask_options are the TransformationContext
+    arguments. Return the image cleared, or the exception met, of each"""
+
+    contexts = [TransformationContext(img, path=file, digest=digest,
+                                      **(mask_options or {}))
+                for file, img, digest in images]
+    try:
+        compute_background_masks(contexts)
+    except Exception as e:
+        # The masks missing are computed one image at a time below, so
+        # only the images in fault are reported
+        model_name = (mask_options or {}).get('model_name', 'u2net')
+        if model_name not in _batch_failures:
+            _batch_failures.add(model_name)
+            print(f"Batch segmentation with {model_name} failed, falling \
+back to one image at a time: {type(e).__name__}: {e}")
+
+    results = []
+    for context in contexts:
+        try:
+            results.append(imgt_clear_background(context.img,
+                                                 context.background_mask))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+class BackgroundPipeline:
+    """Remove the background of (image, output) files in three stages:
+    a pool of reader threads, the batches computed in the calling thread
+    and a pool of encoder threads writing the outputs.
+
+    The stages are connected by queues of at most window files, so the
+    readers stop when the computation is behind and the computation
+    waits when the writers are behind. The time spent in each stage and
+    waiting for the others is summed in times. The files done are listed
+    in finished and the errors met in errors, both printed when verbose.
+    """
+    def __init__(self, source: str, mask_options: dict, batch_size: int,
+                 io_threads: int = 4, manifest: Manifest = None,
+                 verbose: bool = True):
+        self.source = source
+        self.mask_options = mask_options
+        self.batch_size = batch_size
+        self.io_threads = io_threads
+        self.window = max(2 * batch_size, io_threads)
+        self.manifest = manifest
+        self.verbose = verbose
+        self.finished = []
+        self.errors = []
+        self.reads = collections.deque()
+        self.writes = collections.deque()
+        self.done = 0
+        self.times = dict.fromkeys(('read', 'compute', 'write', 'read wait',
+                                    'write wait'), 0.0)
+
+    def error(self, message: str) -> None:
+        self.errors.append(message)
+        if self.verbose:
+            print(message)
+
+    def fill_reads(self, pending) -> None:
+        while len(self.reads) < self.window:
+            task = next(pending, None)
+            if task is None:
+                return
+            self.reads.append((task, self.readers.submit(read_file,
+                                                         task[0])))
+
+    def next_batch(self, pending) -> list:
+        """Wait for the next batch_size images read"""
+        batch = []
+        start = time.perf_counter()
+        while self.reads and len(batch) < self.batch_size:
+            task, future = self.reads.popleft()
+            try:
+                img, digest, elapsed = future.result()
+                self.times['read'] += elapsed
+                batch.append((task, img, digest))
+            except Exception as e:
+                self.error(f"Error on {task[0]}: {e}")
+            self.fill_reads(pending)
+        self.times['read wait'] += time.perf_counter() - start
+        return batch
+
+    def finish_write(self) -> None:
+        """Wait for the oldest output written"""
+        (file, output, digest), future = self.writes.popleft()
+        start = time.perf_counter()
+        try:
+            self.times['write'] += future.result()
+        except Exception as e:
+            self.error(f"Error on {file}: {e}")
+            return
+        finally:
+            self.times['write wait'] += time.perf_counter() - start
+        if self.verbose:
+            print(f"Image {output} Done")
+        self.finished.append((file, output, digest))
+        self.done += 1
+        if self.manifest is not None:
+            self.manifest.record(os.path.relpath(file, self.source), file,
+                                 [output], digest)
+            if self.done % 500 == 0:
+                self.manifest.save()
+
+    def run(self, tasks: list) -> int:
+        """Process the tasks, return the number of images done"""
+        pending = iter(tasks)
+        with ThreadPoolExecutor(self.io_threads) as self.readers, \
+                ThreadPoolExecutor(self.io_threads) as self.writers:
+            self.fill_reads(pending)
+            while self.reads:
+                batch = self.next_batch(pending)
+                start = time.perf_counter()
+                results = clear_background_batch(
+                    [(task[0], img, digest) for task, img, digest in batch],
+                    self.mask_options)
+                self.times['compute'] += time.perf_counter() - start
+                for (task, _, digest), result in zip(batch, results):
+                    if isinstance(result, Exception):
+                        self.error(f"Error on {task[0]}: {result}")
+                        continue
+                    self.writes.append(((*task, digest), self.writers.submit(
+                        write_file, task[1], result)))
+                while len(self.writes) > self.window:
+                    self.finish_write()
+            while self.writes:
+                self.finish_write()
+        return self.done
+
+
+def list_tasks(path: str,
+               destination: str,
+               manifest: Manifest = None,
+               incremental: bool = False) -> tuple:
+    """List the (image, output) files of the images in path, recursively,
+    in the same folders in destination. In incremental mode, the images
+    up to date in the manifest are skipped and the outputs of deleted
+    images are removed.
+    Return the tasks, the number of images skipped and removed"""
+
+    tasks, relpaths = [], set()
+    for file in list_image_files(path):
+        relpath = os.path.relpath(file, path)
+        relpaths.add(relpath)
+        if incremental and manifest is not None \
+                and manifest.is_current(relpath, file):
+            continue
+        tasks.append((file, os.path.join(destination, relpath)))
+
+    removed = 0
+    if incremental and manifest is not None:
+        removed = manifest.remove_deleted(relpaths)
+    return tasks, len(relpaths) - len(tasks), removed
+
+
+def init_worker(mask_options: dict, store: tuple, batch_size: int,
+                io_threads: int, threads: int) -> None:
+    """Give the worker its own mask store connection. The rembg session
+    is created by the worker on its first batch, with threads onnx
+    threads, and kept for the following ones"""
+    os.environ['OMP_NUM_THREADS'] = str(threads)
+    mask_options = dict(mask_options)
+    if store is not None:
+        mask_options['mask_store'] = MaskStore(*store)
+    _worker.update(mask_options=mask_options, batch_size=batch_size,
+                   io_threads=io_threads)
+
+
+def remove_background_chunk(chunk: list) -> tuple:
+    """Worker task: remove the background of a chunk of (image, output)
+    files. Return the files done, the errors and the stage times"""
+    pipeline = BackgroundPipeline(None, _worker['mask_options'],
+                                  _worker['batch_size'],
+                                  _worker['io_threads'], verbose=False)
+    pipeline.run(chunk)
+    return len(chunk), pipeline.finished, pipeline.errors, pipeline.times
+
+
+def remove_background_workers(tasks: list, mask_options: dict,
+                              store: tuple, batch_size: int,
+                              io_threads: int, workers: int,
+                              source: str, manifest: Manifest) -> tuple:
+    """Spread the tasks over a pool of workers processes, by chunks of a
+    few batches, with one progress bar for all of them.
+    Return the number of images done and the stage times summed"""
+    threads = max(1, os.cpu_count() // workers)
+    chunk_size = 4 * batch_size
+    chunks = [tasks[i:i + chunk_size]
+              for i in range(0, len(tasks), chunk_size)]
+    times = dict.fromkeys(('read', 'compute', 'write', 'read wait',
+                           'write wait'), 0.0)
+    done = 0
+
+    with multiprocessing.Pool(workers, init_worker,
+                              (mask_options, store, batch_size, io_threads,
+                               threads)) as pool, \
+            tqdm(total=len(tasks)) as progress:
+        for nb_tasks, finished, errors, chunk_times in pool.imap_unordered(
+                remove_background_chunk, chunks):
+            for message in errors:
+                tqdm.write(message)
+            for stage, seconds in chunk_times.items():
+                times[stage] += seconds
+            if manifest is not None:
+                for file, output, digest in finished:
+                    manifest.record(os.path.relpath(file, source), file,
+                                    [output], digest)
+                if (done + len(finished)) // 500 > done // 500:
+                    manifest.save()
+            done += len(finished)
+            progress.update(nb_tasks)
+    return done, times
+
+
+def remove_background(path: str,
+                      destination: str,
+                      mask_options: dict = None,
+                      batch_size: int = 8,
+                      manifest: Manifest = None,
+                      incremental: bool = False,
+                      io_threads: int = 4,
+                      workers: int = 1,
+                      store: tuple = None) -> tuple:
+    """Remove the background of the images in path, recursively, into the
+    same folders in destination, in this process or on a pool of workers
+    processes. store is the path and size of the mask store. The images
+    done are recorded in the manifest. In incremental mode, the outputs
+    of a run with other parameters are removed once the images are done.
+    Return the number of images done, skipped and removed, and the time
+    spent in each stage"""
+
+    tasks, skipped, removed = list_tasks(path, destination, manifest,
+                                         incremental)
+    mask_options = mask_options or {}
+    try:
+        if workers > 1:
+            done, times = remove_background_workers(
+                tasks, mask_options, store, batch_size, io_threads,
+                workers, path, manifest)
+        else:
+            mask_store = MaskStore(*store) if store is not None else None
+            pipeline = BackgroundPipeline(path, dict(mask_options,
+                                                     mask_store=mask_store),
+                                          batch_size, io_threads, manifest)
+            try:
+                pipeline.run(tasks)
+            finally:
+                if mask_store is not None:
+                    mask_store.close()
+            done, times = pipeline.done, pipeline.times
+        if incremental and manifest is not None:
+            stale = manifest.remove_stale()
+            if stale:
+                print(f"{stale} outputs of a run with other parameters \
+removed")
+    finally:
+        if manifest is not None:
+            manifest.save()
+    return done, skipped, removed, times
 
 
 def main():
@@ -53,6 +331,69 @@ def main():
                          expected_type=str,
                          default="background_removed_images"
                          ),
+            OptionObject('rembg-model', 'The rembg model segmenting the \
+background',
+                         name='rm',
+                         expected_type=str,
+                         default='u2net',
+                         check_function=check_rembg_model
+                         ),
+            OptionObject('background-mode', 'quality segments the \
+background with rembg, fast with a lab threshold for uniform backgrounds',
+                         name='bm',
+                         expected_type=str,
+                         default='quality',
+                         check_function=check_background_mode
+                         ),
+            OptionObject('mask-store', 'The file storing the background \
+masks, shared with Transformation.py',
+                         name='ms',
+                         expected_type=str,
+                         default=None
+                         ),
+            OptionObject('mask-store-size', 'The maximum size of the mask \
+store in MB',
+                         name='mz',
+                         expected_type=int,
+                         default=1024
+                         ),
+            OptionObject('batch-size', 'The number of images segmented by \
+rembg at once',
+                         name='b',
+                         expected_type=int,
+                         default=8
+                         ),
+            OptionObject('scale', 'Compute the masks on the images resized \
+by this scale, then upscale them',
+                         name='sc',
+                         expected_type=float,
+                         default=1.0,
+                         check_function=check_scale
+                         ),
+            OptionObject('refine', 'Smooth the edges of the upscaled masks',
+                         name='re',
+                         expected_type=bool,
+                         default=False
+                         ),
+            OptionObject('incremental', 'Only process the images new or \
+changed since the last run in destination, and remove the outputs of the \
+deleted ones',
+                         name='i',
+                         expected_type=bool,
+                         default=False
+                         ),
+            OptionObject('io-threads', 'The number of threads reading and \
+the number of threads writing the images',
+                         name='io',
+                         expected_type=int,
+                         default=4
+                         ),
+            OptionObject('workers', 'The number of processes, each with \
+its own rembg session and cores / workers onnx threads',
+                         name='j',
+                         expected_type=int,
+                         default=1
+                         ),
         ],
         """This program works recursively in folders\n"""
     )
@@ -74,11 +415,33 @@ def main():
     elif not os.path.isdir(destination):
         print("Destination is not a folder")
         return
-    elif os.listdir(destination):
-        print("Destination folder is not empty")
+    elif os.listdir(destination) and not user_input['incremental']:
+        print("Destination folder is not empty, use --incremental to \
+update it")
         return
 
-    remove_background(path, destination)
+    store = None
+    if user_input.get('mask-store'):
+        store = (user_input['mask-store'],
+                 user_input['mask-store-size'] << 20)
+    mask_options = {'model_name': user_input['rembg-model'],
+                    'background_mode': user_input['background-mode'],
+                    'scale': user_input['scale'],
+                    'refine': user_input['refine']}
+    manifest = Manifest(destination, dict(mask_options,
+                                          tool='RemoveBackground'))
+    try:
+        done, skipped, removed, times = remove_background(
+            path, destination, mask_options,
+            max(1, user_input['batch-size']), manifest,
+            user_input['incremental'], max(1, user_input['io-threads']),
+            user_input['workers'], store)
+    except KeyboardInterrupt:
+        print("Interrupted by user")
+        return
+    print(f"{done} images done, {skipped} up to date, {removed} removed")
+    print(', '.join(f"{stage} {seconds:.1f}s"
+                    for stage, seconds in times.items()))
 
 
 if __name__ == "__main__":
@@ -2,16 +2,30 @@
 
 import matplotlib.image as mplimg
 import matplotlib.pyplot as plt
+import multiprocessing
 import os
 
+from plantcv import plantcv as pcv
+from tqdm import tqdm
+
 from utils.ArgsHandler import ArgsHandler, ArgsObject, OptionObject
 from utils.ArgsHandler import display_helper
 
-from utils.data_transformation import imgt_mask_disease, imgt_mask_background
 from utils.data_transformation import imgt_gaussian_blur, imgt_leaf_mask
 from utils.data_transformation import imgt_roi, imgt_y_pseudolandmarks
 from utils.data_transformation import imgt_x_pseudolandmarks, imgt_analyse
 from utils.data_transformation import imgt_color_histogram
+from utils.data_transformation import check_rembg_model, check_scale
+from utils.data_transformation import check_background_mode
+from utils.transformation_context import TransformationContext
+from utils.transformation_render import save_transformation
+from utils.mask_store import MaskStore
+from utils.image_loader import list_image_files
+from utils.manifest import Manifest
+
+
+# State of a folder mode worker, set by init_worker
+_worker = {}
 
 
 def check_transformation(args_handler, inpt_u):
@@ -62,16 +76,18 @@ If you provide a source please give a destination too.")
 def apply_transformation(path,
                          transformation_list,
                          color_histogram,
-                         dest=None,
-                         save=False
+                         mask_options=None
                          ):
-    """Apply all transformation to the image"""
+    """Apply all transformation to the image and display them.
+    mask_options are the TransformationContext arguments"""
     try:
         img = mplimg.imread(path)
     except Exception as e:
         print(e)
         return
 
+    context = TransformationContext(img, path=path, **(mask_options or {}))
+
     fig = plt.figure(figsize=(8, 4))
     fig.canvas.manager.set_window_title('Image Transformation')
     fig.subplots_adjust(wspace=0.3, hspace=0.3)
@@ -82,32 +98,33 @@ def apply_transformation(path,
     plt.imshow(img)
     plt.title('Original')
 
-    background_mask = imgt_mask_background(img)
-    disease_mask = imgt_mask_disease(img, background_mask)
-
     for i, transformation in enumerate(transformation_list):
         fig.add_subplot(subplots_size, 4, i + 2)
         if transformation == 'background':
-            plt.imshow(background_mask, cmap='gray')
+            plt.imshow(context.background_mask, cmap='gray')
             plt.title('Background mask')
         elif transformation == 'gaussian-blur':
-            gaussian_img = imgt_gaussian_blur(disease_mask, ksize=(7, 7))
+            gaussian_img = imgt_gaussian_blur(context.disease_mask,
+                                              ksize=(7, 7))
             plt.imshow(gaussian_img, cmap='gray')
             plt.title('Gaussian Blur')
         elif transformation == 'mask':
-            mask_img = imgt_leaf_mask(img, disease_mask)
+            mask_img = imgt_leaf_mask(img, context.disease_mask)
             plt.imshow(mask_img, cmap='gray')
             plt.title('disease mask')
         elif transformation == 'roi':
-            roi_img = imgt_roi(img, disease_mask)
+            roi_img = imgt_roi(img, context.disease_mask,
+                               context.roi_mask)
             plt.imshow(roi_img)
             plt.title('ROI')
         elif transformation == 'analyse':
-            analyse_img = imgt_analyse(img, disease_mask)
+            analyse_img = imgt_analyse(img, context.disease_mask,
+                                       context.roi_mask)
             plt.imshow(analyse_img)
             plt.title('Analyse')
         elif transformation == 'pseudolandmarks-x':
-            top, bot, ctrv = imgt_x_pseudolandmarks(img, disease_mask)
+            top, bot, ctrv = imgt_x_pseudolandmarks(
+                img, context.disease_mask, context.roi_mask)
             plt.imshow(img)
             plt.scatter(x=[d[0][0] for d in bot], y=[d[0][1] for d in bot],
                         color=(253 / 255, 1 / 255, 255 / 255))
@@ -117,7 +134,8 @@ def apply_transformation(path,
                         color=(255 / 255, 79 / 255, 0 / 255))
             plt.title('Pseudolandmarks X')
         elif transformation == 'pseudolandmarks-y':
-            lft, rht, ctrh = imgt_y_pseudolandmarks(img, disease_mask)
+            lft, rht, ctrh = imgt_y_pseudolandmarks(
+                img, context.disease_mask, context.roi_mask)
             plt.imshow(img)
             plt.scatter(x=[d[0][0] for d in lft], y=[d[0][1] for d in lft],
                         color=(253 / 255, 1 / 255, 255 / 255))
@@ -127,18 +145,13 @@ def apply_transformation(path,
                         color=(255 / 255, 79 / 255, 0 / 255))
             plt.title('Pseudolandmarks Y')
 
-    if save:
-        try:
-            fig.savefig(f"{dest}/{os.path.basename(path)[:-4]}_transfo.png")
-        except Exception as e:
-            print(e)
-        plt.close(fig)
-
     if color_histogram:
         fig2 = plt.figure(figsize=(8, 4))
         fig2.canvas.manager.set_window_title('Image Color Histogram')
 
-        c_hist, all_freq = imgt_color_histogram(img, disease_mask)
+        c_hist, all_freq = imgt_color_histogram(img,
+                                                context.disease_mask,
+                                                context.roi_mask)
 
         for color in c_hist:
             plt.plot(c_hist[color][0],
@@ -150,22 +163,103 @@ def apply_transformation(path,
         plt.ylabel('Proportions of pixles (%)')
         plt.legend(all_freq, loc='upper left')
 
-        if save:
-            try:
-                fig2.savefig(f"{dest}/{os.path.basename(path)[:-4]}_hist.png")
-            except Exception as e:
-                print(e)
-            plt.close(fig2)
 
+def init_worker(transformation_list, color_histogram, mask_options,
+                store=None, threads=None):
+    """Give the worker its own plantcv state and mask store connection.
+    The rembg session is created by the worker on its first image, with
+    threads onnx threads"""
+    if threads is not None:
+        os.environ['OMP_NUM_THREADS'] = str(threads)
+    plt.switch_backend('Agg')
+    pcv.params.debug = None
+    pcv.outputs.clear()
+    mask_options = dict(mask_options)
+    if store is not None:
+        mask_options['mask_store'] = MaskStore(*store)
+    _worker.update(transformation_list=transformation_list,
+                   color_histogram=color_histogram,
+                   mask_options=mask_options)
+
+
+def transform_file(task):
+    """Save the transformations of one image under the output stem.
+    Return the path of the image with its content hash, or the error met"""
+    path, stem = task
+    try:
+        img = mplimg.imread(path)
+        context = TransformationContext(img, path=path,
+                                        **_worker['mask_options'])
+        os.makedirs(os.path.dirname(stem), exist_ok=True)
+        save_transformation(img, context, _worker['transformation_list'],
+                            _worker['color_histogram'], stem)
+        return path, context.digest, None
+    except Exception as e:
+        return path, None, str(e)
+
+
+def apply_transformation_folder(path, transfo, c_hist, dest,
+                                mask_options=None, store=None, workers=1,
+                                incremental=False):
+    """Apply all transformation to the images in the folder on a pool of
+    workers, mirroring the folders of path in dest. store is the path
+    and size of the mask store each worker opens. The images done are
+    recorded in the manifest of dest. In incremental mode, the images up
+    to date in the manifest are skipped, the outputs of deleted images
+    are removed, and so are those of a run with other parameters once
+    the images are done.
+    Return the number of images, of images in error, skipped and removed"""
+    manifest = Manifest(dest, {'tool': 'Transformation',
+                               'transformation': sorted(transfo),
+                               'color-histogram': c_hist,
+                               **(mask_options or {})})
+    tasks, relpaths = [], set()
+    for file in list_image_files(path):
+        relpath = os.path.relpath(file, path)
+        relpaths.add(relpath)
+        if not incremental or not manifest.is_current(relpath, file):
+            tasks.append((file, os.path.join(dest, os.path.splitext(
+                relpath)[0])))
+    removed = manifest.remove_deleted(relpaths) if incremental else 0
+    stems = dict(tasks)
+    init_args = (transfo, c_hist, mask_options or {}, store)
+
+    pool = None
+    if workers > 1:
+        threads = max(1, os.cpu_count() // workers)
+        pool = multiprocessing.Pool(workers, init_worker,
+                                    init_args + (threads,))
+        results = pool.imap_unordered(transform_file, tasks)
+    else:
+        init_worker(*init_args)
+        results = map(transform_file, tasks)
 
-def apply_transformation_folder(path, transfo, c_hist, dest):
-    """Apply all transformation to the image in the folder"""
-    with os.scandir(path) as entries:
-        for entry in entries:
-            if entry.is_file():
-                apply_transformation(entry.path, transfo, c_hist, dest, True)
-            elif entry.is_dir():
-                apply_transformation_folder(entry.path, transfo, c_hist, dest)
+    errors, stale = 0, 0
+    try:
+        for done, (file, digest, error) in enumerate(
+                tqdm(results, total=len(tasks)), 1):
+            if error is not None:
+                tqdm.write(f"Error on {file}: {error}")
+                errors += 1
+                continue
+            outputs = [stems[file] + '_transfo.png']
+            if c_hist:
+                outputs.append(stems[file] + '_hist.png')
+            manifest.record(os.path.relpath(file, path), file, outputs,
+                            digest)
+            if done % 500 == 0:
+                manifest.save()
+        if incremental:
+            stale = manifest.remove_stale()
+    finally:
+        manifest.save()
+        if pool is not None:
+            pool.terminate()
+        elif _worker['mask_options'].get('mask_store') is not None:
+            _worker['mask_options']['mask_store'].close()
+    if stale:
+        print(f"{stale} outputs of a run with other parameters removed")
+    return len(tasks), errors, len(relpaths) - len(tasks), removed
 
 
 def main():
@@ -215,6 +309,58 @@ histogram of the image',
                                      name='c',
                                      expected_type=bool,
                                      default=False
+                                     ),
+                        OptionObject('rembg-model', 'The rembg model \
+segmenting the background',
+                                     name='rm',
+                                     expected_type=str,
+                                     default='u2net',
+                                     check_function=check_rembg_model
+                                     ),
+                        OptionObject('background-mode', 'quality segments \
+the background with rembg, fast with a lab threshold for uniform backgrounds',
+                                     name='bm',
+                                     expected_type=str,
+                                     default='quality',
+                                     check_function=check_background_mode
+                                     ),
+                        OptionObject('mask-store', 'The file storing the \
+background masks, shared with RemoveBackground.py',
+                                     name='ms',
+                                     expected_type=str,
+                                     default=None
+                                     ),
+                        OptionObject('mask-store-size', 'The maximum size \
+of the mask store in MB',
+                                     name='mz',
+                                     expected_type=int,
+                                     default=1024
+                                     ),
+                        OptionObject('scale', 'Compute the masks on the \
+image resized by this scale, then upscale them',
+                                     name='sc',
+                                     expected_type=float,
+                                     default=1.0,
+                                     check_function=check_scale
+                                     ),
+                        OptionObject('refine', 'Smooth the edges of the \
+upscaled masks',
+                                     name='re',
+                                     expected_type=bool,
+                                     default=False
+                                     ),
+                        OptionObject('workers', 'The number of processes \
+transforming the images of a folder',
+                                     name='j',
+                                     expected_type=int,
+                                     default=os.cpu_count()
+                                     ),
+                        OptionObject('incremental', 'Only transform the \
+images of the folder new or changed since the last run in destination, and \
+remove the outputs of the deleted ones',
+                                     name='i',
+                                     expected_type=bool,
+                                     default=False
                                      )
                     ],
                     """"""
@@ -238,15 +384,39 @@ histogram of the image',
     transformation_list = user_input['transformation']
     color_histogram = user_input['color-histogram']
 
+    if path_type == 'folder':
+        plt.switch_backend('Agg')
+
+    store = None
+    if user_input.get('mask-store'):
+        store = (user_input['mask-store'],
+                 user_input['mask-store-size'] << 20)
+    mask_options = {'model_name': user_input['rembg-model'],
+                    'background_mode': user_input['background-mode'],
+                    'scale': user_input['scale'],
+                    'refine': user_input['refine']}
+
     if path_type == 'file':
-        apply_transformation(path,
-                             transformation_list,
-                             color_histogram)
+        mask_store = MaskStore(*store) if store is not None else None
+        try:
+            apply_transformation(path,
+                                 transformation_list,
+                                 color_histogram,
+                                 dict(mask_options, mask_store=mask_store))
+        finally:
+            if mask_store is not None:
+                mask_store.close()
     else:
-        apply_transformation_folder(path,
-                                    transformation_list,
-                                    color_histogram,
-                                    destination)
+        try:
+            nb_images, errors, skipped, removed = apply_transformation_folder(
+                path, transformation_list, color_histogram, destination,
+                mask_options, store, user_input['workers'],
+                user_input['incremental'])
+        except KeyboardInterrupt:
+            print("Interrupted by user")
+            return
+        print(f"{nb_images - errors}/{nb_images} images transformed in \
+{destination}, {skipped} up to date, {removed} removed")
 
     try:
         if path_type == 'file':
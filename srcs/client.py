@@ -0,0 +1,135 @@
+#!/bin/env python3
+
+import json
+import time
+import socket
+import http.client
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.ArgsHandler import ArgsHandler, ArgsObject, OptionObject
+from utils.ArgsHandler import display_helper
+from utils.image_loader import list_image_files
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP connection over a unix socket"""
+    def __init__(self, path: str):
+        super().__init__('localhost')
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+def request(user_input, method, url, body=None, headers=None):
+    """Send one request to the server and return its json answer"""
+    if user_input.get('socket'):
+        connection = UnixHTTPConnection(user_input['socket'])
+    else:
+        connection = http.client.HTTPConnection(user_input['host'],
+                                                user_input['port'])
+    try:
+        connection.request(method, url, body, headers or {})
+        response = connection.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        connection.close()
+
+
+def predict_file(user_input, path):
+    """Send the bytes of one image and time the answer"""
+    with open(path, 'rb') as f:
+        body = f.read()
+    start = time.perf_counter()
+    status, answer = request(user_input, 'POST', '/predict', body,
+                             {'Content-Type': 'application/octet-stream'})
+    return path, status, answer, time.perf_counter() - start
+
+
+def main():
+    """Main"""
+    args_handler = ArgsHandler(
+        'This program send the images of a folder to server.py with \
+concurrent requests and display the predictions and latencies',
+        [
+            ArgsObject('images_path', 'The path of the targeted images')
+        ],
+        [
+            OptionObject('help', 'Show this help message',
+                         name='h',
+                         expected_type=bool,
+                         default=False,
+                         check_function=display_helper
+                         ),
+            OptionObject('host', 'The host of the server',
+                         name='H',
+                         expected_type=str,
+                         default='127.0.0.1'),
+            OptionObject('port', 'The port of the server',
+                         name='p',
+                         expected_type=int,
+                         default=8000),
+            OptionObject('socket', 'The unix socket of the server',
+                         name='u',
+                         expected_type=str,
+                         default=None),
+            OptionObject('concurrency', 'The number of concurrent requests',
+                         name='c',
+                         expected_type=int,
+                         default=8),
+            OptionObject('show', 'Show the prediction of every image',
+                         name='s',
+                         expected_type=bool,
+                         default=False)
+        ],
+        """"""
+    )
+
+    try:
+        user_input = args_handler.parse_args()
+        args_handler.check_args(user_input)
+    except SystemExit:
+        return
+    except Exception as e:
+        print(e)
+        return
+
+    try:
+        paths = list_image_files(user_input['args'][0])
+    except Exception as e:
+        print(e)
+        return
+
+    latencies = []
+    start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(user_input['concurrency']) as executor:
+            results = executor.map(lambda path: predict_file(user_input,
+                                                             path), paths)
+            for path, status, answer, latency in results:
+                latencies.append(latency)
+                if status != 200:
+                    print(f"{path}: {answer.get('error')}")
+                elif user_input['show']:
+                    print(f"{path} == {answer['prediction']} -> \
+{100 * answer['confidence']:.2f}%")
+        elapsed = time.perf_counter() - start
+        _, metrics = request(user_input, 'GET', '/metrics')
+    except Exception as e:
+        print(e)
+        return
+
+    if not latencies:
+        return
+    latencies = np.array(latencies) * 1000
+    print(f"{len(latencies)} requests in {elapsed:.2f}s \
+({len(latencies) / elapsed:.1f} images/s)")
+    print(f"client latency p50 {np.percentile(latencies, 50):.1f}ms, \
+p95 {np.percentile(latencies, 95):.1f}ms")
+    print(f"server metrics: {json.dumps(metrics)}")
+
+
+if __name__ == "__main__":
+    main()
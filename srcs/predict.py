@@ -1,31 +1,74 @@
 #!/bin/env python3
 
-import tensorflow as tf
 import matplotlib.pyplot as plt
-import tensorflow.keras.preprocessing.image as preprocessing
 import pickle
 import os
+import csv
+import time
 import numpy as np
 
 from utils.ArgsHandler import ArgsHandler, ArgsObject, OptionObject
 from utils.ArgsHandler import display_helper
+from utils.image_loader import list_image_files, load_images
+from utils.image_loader import iter_image_batches, read_image
+from utils.data_split import split_files
+from utils.predictor import load_predictor
+from utils.prediction_cache import PredictionCache
+from utils.hashing import file_digest
+from utils.prediction_cache import model_fingerprint
 
 
-def load_all_image(path: str) -> list:
-    """Get the max folder size at depth from path"""
-    all_img = []
-    with os.scandir(path) as it:
-        for entry in it:
-            if entry.is_file():
-                img = preprocessing.load_img(entry.path,
-                                             target_size=(256, 256))
+def predict_all(predictor, images: np.ndarray, batch_size: int) -> tuple:
+    """Score all the images by batch.
+    Return the scores and the seconds spent in the model"""
+    scores = []
+    elapsed = 0.0
+    for i in range(0, len(images), batch_size):
+        start = time.perf_counter()
+        scores.append(predictor(images[i:i + batch_size]))
+        elapsed += time.perf_counter() - start
+    return np.concatenate(scores), elapsed
 
-                img_array = preprocessing.img_to_array(img)
-                all_img.append((entry.name, img_array, img))
-            elif entry.is_dir():
-                all_img += load_all_image(entry.path)
-        print(f"{os.path.basename(path)} done")
-        return all_img
+
+def score_batches(paths, predictor, batch_size, workers, cache=None):
+    """Yield (paths, images, scores) batches. With a cache, the scores of
+    known images are yielded first, without decoding them (images is
+    None), and only the other images go through the model"""
+    todo = paths
+    if cache is not None:
+        digests = {path: file_digest(path) for path in paths}
+        found = cache.get_many(list(digests.values()))
+        hits = [path for path in paths if digests[path] in found]
+        for i in range(0, len(hits), batch_size):
+            batch_paths = hits[i:i + batch_size]
+            yield batch_paths, None, np.stack([found[digests[path]]
+                                               for path in batch_paths])
+        todo = [path for path in paths if digests[path] not in found]
+
+    for batch_paths, images in iter_image_batches(todo, batch_size, workers):
+        scores = predictor(images)
+        if cache is not None:
+            cache.put_many([digests[path] for path in batch_paths], scores)
+        yield batch_paths, images, scores
+
+
+def compare_models(names, images, labels, model_path, tflite_path,
+                   batch_size):
+    """Print the accuracy and the latency of the keras model and of the
+    TFLite model on the same images"""
+    results = {}
+    for kind, lite in (('keras', None), ('tflite', tflite_path)):
+        predictor = load_predictor(model_path, lite)
+        predictor(images[:batch_size])
+        scores, elapsed = predict_all(predictor, images, batch_size)
+        guesses = np.argmax(scores, axis=1)
+        right = sum(labels[g] in name for name, g in zip(names, guesses))
+        results[kind] = guesses
+        print(f"{kind:>8}: {100 * right / len(names):6.2f}% accuracy, \
+{1000 * elapsed / len(names):8.3f} ms/image, \
+{len(names) / elapsed:8.1f} images/s")
+    agreement = np.mean(results['keras'] == results['tflite'])
+    print(f"   agree: {100 * agreement:6.2f}% of the predictions")
 
 
 def main():
@@ -34,7 +77,8 @@ def main():
         'This program take an image as arguments en display some \
 modifications on it',
         [
-            ArgsObject('images_path', 'The path of the targeted images'),
+            ArgsObject('images_path', 'The path of the targeted images',
+                       Optional=True),
         ],
         [
             OptionObject('help', 'Show this help message',
@@ -55,7 +99,50 @@ modifications on it',
             OptionObject('show', 'Show the prediction value',
                          name='s',
                          expected_type=bool,
-                         default=False,)
+                         default=False,),
+            OptionObject('workers', 'The number of processes decoding \
+the images',
+                         name='j',
+                         expected_type=int,
+                         default=os.cpu_count()),
+            OptionObject('split', 'Evaluate a subset of the split file \
+saved by train.py instead of images_path',
+                         name='sp',
+                         expected_type=str,
+                         default=None),
+            OptionObject('subset', 'The subset of the split: train, valid \
+or test',
+                         name='ss',
+                         expected_type=str,
+                         default='test'),
+            OptionObject('tflite', 'Run this TFLite model exported by \
+train.py --export instead of the keras model',
+                         name='l',
+                         expected_type=str,
+                         default=None),
+            OptionObject('compare', 'Compare the accuracy and latency of \
+the keras model and the TFLite model',
+                         name='c',
+                         expected_type=bool,
+                         default=False),
+            OptionObject('batch-size', 'The number of images per batch',
+                         name='b',
+                         expected_type=int,
+                         default=32),
+            OptionObject('output', 'Write the prediction of every image in \
+this CSV file as each batch finishes',
+                         name='o',
+                         expected_type=str,
+                         default=None),
+            OptionObject('cache', 'Cache the scores in this file, keyed by \
+the image content and the model',
+                         name='ca',
+                         expected_type=str,
+                         default=None),
+            OptionObject('cache-size', 'The maximum number of cached scores',
+                         name='cz',
+                         expected_type=int,
+                         default=1000000)
         ],
         """"""
     )
@@ -69,18 +156,45 @@ modifications on it',
         print(e)
         return
 
-    img_path = user_input['args'][0]
     model_path = user_input['model']
 
     try:
-        all_image = load_all_image(img_path)
+        if user_input.get('split'):
+            paths = split_files(user_input['split'], user_input['subset'])
+            names = [os.path.join(os.path.basename(os.path.dirname(path)),
+                                  os.path.basename(path)) for path in paths]
+        elif len(user_input['args']) == 1:
+            paths = list_image_files(user_input['args'][0])
+            names = [os.path.basename(path) for path in paths]
+        else:
+            raise ValueError("Expected images_path or a split file")
     except Exception as e:
         print(e)
         return
 
+    tflite_path = user_input.get('tflite')
+    batch_size = user_input['batch-size']
+    workers = user_input['workers']
+
     try:
         labels = pickle.load(open('labels.pkl', 'rb'))
-        model = tf.keras.models.load_model(model_path)
+        if user_input['compare']:
+            if not tflite_path:
+                raise ValueError("--compare needs a --tflite model")
+            images = load_images(paths, workers)
+            compare_models(names, images, labels, model_path, tflite_path,
+                           batch_size)
+            return
+        predictor = load_predictor(model_path, tflite_path)
+        cache = None
+        if user_input.get('cache'):
+            fingerprint = model_fingerprint([tflite_path or model_path,
+                                             'labels.pkl'])
+            cache = PredictionCache(user_input['cache'], fingerprint,
+                                    user_input['cache-size'])
+        output = None
+        if user_input.get('output'):
+            output = open(user_input['output'], 'w', newline='')
     except Exception as e:
         print(e)
         return
@@ -91,34 +205,59 @@ modifications on it',
     END = '\033[0m'
 
     right_guesses = 0
+    done = 0
+    path_names = dict(zip(paths, names))
 
-    if not user_input['show']:
-        path, images_array, a = zip(*all_image)
-        predictions = model.predict(np.array(images_array))
-        right_guesses = sum((labels[tf.argmax(score)] in name)
-                            for (name, score) in zip(path, predictions))
-    else:
-        for name, img, real_img in all_image:
+    if output is not None:
+        writer = csv.writer(output)
+        writer.writerow(['path', 'prediction', 'confidence', 'correct'])
+
+    try:
+        for batch_paths, images, scores in score_batches(
+                paths, predictor, batch_size, workers, cache):
+            done += len(batch_paths)
 
-            score = model(np.expand_dims(img, axis=0))[0]
-            is_right_guess = labels[tf.argmax(score)] in name
+            for i, (path, score) in enumerate(zip(batch_paths, scores)):
+                name = path_names[path]
+                guess = labels[np.argmax(score)]
+                is_right_guess = guess in name
+                right_guesses += is_right_guess
 
-            C = GREEN if is_right_guess else RED
-            print(f"{C}{name:^24} == {labels[tf.argmax(score)]:^15}\
- -> {100 * tf.reduce_max(score):.2f}%{END}")
+                if output is not None:
+                    writer.writerow([path, guess, f"{np.max(score):.4f}",
+                                     int(is_right_guess)])
 
-            right_guesses += is_right_guess
+                if not user_input['show']:
+                    continue
 
-            if user_input['plot']:
-                c = 'green' if is_right_guess else 'red'
-                plt.text(0, -17, os.path.basename(name), color=c, fontsize=25)
-                plt.imshow(real_img)
-                try:
+                C = GREEN if is_right_guess else RED
+                print(f"{C}{name:^24} == {guess:^15}\
+ -> {100 * np.max(score):.2f}%{END}")
+
+                if user_input['plot']:
+                    c = 'green' if is_right_guess else 'red'
+                    plt.text(0, -17, os.path.basename(name), color=c,
+                             fontsize=25)
+                    plt.imshow(read_image(path) if images is None
+                               else images[i])
                     plt.show()
-                except KeyboardInterrupt:
-                    break
+            if output is not None:
+                output.flush()
+    except KeyboardInterrupt:
+        print("Interrupted by user")
+    except Exception as e:
+        print(e)
+    finally:
+        if output is not None:
+            output.close()
+        if cache is not None:
+            print(f"Prediction cache: {cache.hits} hits, \
+{cache.misses} misses")
+            cache.close()
 
-    valid_percent = 100 * right_guesses / len(all_image)
+    if done == 0:
+        return
+    valid_percent = 100 * right_guesses / done
     print(BOLD + f"{valid_percent:.2f}%" + END +
           " of images where correctly identified")
 
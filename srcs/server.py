@@ -0,0 +1,187 @@
+#!/bin/env python3
+
+import io
+import os
+import json
+import pickle
+import socketserver
+import numpy as np
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from utils.ArgsHandler import ArgsHandler, OptionObject
+from utils.ArgsHandler import display_helper
+from utils.image_loader import read_image
+from utils.micro_batcher import MicroBatcher
+from utils.predictor import load_predictor
+
+
+class PredictionHandler(BaseHTTPRequestHandler):
+    """POST /predict with the image bytes, or a json {"path": ...} body,
+    answers the predicted label and scores. GET /metrics answers the
+    counters of the batcher"""
+    batcher = None
+    labels = None
+
+    def send_json(self, code: int, data: dict) -> None:
+        body = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            self.send_json(200, self.batcher.metrics())
+        else:
+            self.send_json(404, {'error': f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self.send_json(404, {'error': f"Unknown path {self.path}"})
+            return
+        try:
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            if self.headers.get('Content-Type') == 'application/json':
+                image = read_image(json.loads(body)['path'])
+            else:
+                image = read_image(io.BytesIO(body))
+        except Exception as e:
+            self.send_json(400, {'error': f"Invalid image: {e}"})
+            return
+        try:
+            score = self.batcher.predict(image, timeout=60)
+        except Exception as e:
+            self.send_json(500, {'error': str(e)})
+            return
+        self.send_json(200, {
+            'prediction': self.labels[int(np.argmax(score))],
+            'confidence': float(np.max(score)),
+            'scores': {label: float(s) for label, s in zip(self.labels,
+                                                           score)}})
+
+    def address_string(self):
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn,
+                              socketserver.UnixStreamServer):
+    """HTTP server listening on a unix socket"""
+    daemon_threads = True
+
+
+def main():
+    """Main"""
+    args_handler = ArgsHandler(
+        'This program load the model once and serve predictions over \
+HTTP, grouping concurrent requests into micro-batches',
+        [],
+        [
+            OptionObject('help', 'Show this help message',
+                         name='h',
+                         expected_type=bool,
+                         default=False,
+                         check_function=display_helper
+                         ),
+            OptionObject('model', 'The model to use',
+                         name='m',
+                         expected_type=str,
+                         default='model.keras',
+                         ),
+            OptionObject('tflite', 'Serve this TFLite model instead of the \
+keras model',
+                         name='l',
+                         expected_type=str,
+                         default=None),
+            OptionObject('host', 'The host to listen on',
+                         name='H',
+                         expected_type=str,
+                         default='127.0.0.1'),
+            OptionObject('port', 'The port to listen on',
+                         name='p',
+                         expected_type=int,
+                         default=8000),
+            OptionObject('socket', 'Listen on this unix socket instead of \
+host and port',
+                         name='u',
+                         expected_type=str,
+                         default=None),
+            OptionObject('max-batch-size', 'The maximum number of images \
+scored together',
+                         name='b',
+                         expected_type=int,
+                         default=16),
+            OptionObject('max-wait', 'The maximum milliseconds a request \
+waits for others to fill its batch',
+                         name='w',
+                         expected_type=float,
+                         default=5.0),
+            OptionObject('verbose', 'Log every request',
+                         name='v',
+                         expected_type=bool,
+                         default=False)
+        ],
+        """POST /predict with image bytes or {"path": ...} as json,
+GET /metrics for the latency and queue depth counters
+"""
+    )
+
+    try:
+        user_input = args_handler.parse_args()
+        args_handler.check_args(user_input)
+    except SystemExit:
+        return
+    except Exception as e:
+        print(e)
+        return
+
+    try:
+        labels = pickle.load(open('labels.pkl', 'rb'))
+        predictor = load_predictor(user_input['model'],
+                                   user_input.get('tflite'))
+    except Exception as e:
+        print(e)
+        return
+
+    batcher = MicroBatcher(predictor,
+                           user_input['max-batch-size'],
+                           user_input['max-wait'] / 1000)
+    PredictionHandler.batcher = batcher
+    PredictionHandler.labels = labels
+
+    try:
+        if user_input.get('socket'):
+            if os.path.exists(user_input['socket']):
+                os.remove(user_input['socket'])
+            server = ThreadingUnixHTTPServer(user_input['socket'],
+                                             PredictionHandler)
+            address = user_input['socket']
+        else:
+            server = ThreadingHTTPServer((user_input['host'],
+                                          user_input['port']),
+                                         PredictionHandler)
+            address = f"http://{user_input['host']}:{user_input['port']}"
+    except Exception as e:
+        print(e)
+        batcher.close()
+        return
+    server.verbose = user_input['verbose']
+
+    print(f"Serving {len(labels)} labels on {address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Interrupted by user")
+    finally:
+        server.server_close()
+        batcher.close()
+        if user_input.get('socket'):
+            os.remove(user_input['socket'])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+import os
+
+from utils.hashing import file_digest
+from utils.manifest import Manifest
+
+
+PARAMS = {'tool': 'Transformation', 'transformation': ['blur', 'mask']}
+
+
+def write(path, content: bytes) -> str:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+    return str(path)
+
+
+def recorded(tmp_path, params=PARAMS):
+    """A saved manifest of dest with one source, a.jpg, and its output"""
+    source = write(tmp_path / 'src' / 'a.jpg', b'leaf')
+    output = write(tmp_path / 'dest' / 'a_transfo.png', b'out')
+    manifest = Manifest(str(tmp_path / 'dest'), params)
+    manifest.record('a.jpg', source, [output], file_digest(source))
+    manifest.save()
+    return source, output
+
+
+def test_is_current_when_only_the_mtime_changed(tmp_path):
+    source, _ = recorded(tmp_path)
+    stat = os.stat(source)
+    os.utime(source, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    manifest = Manifest(str(tmp_path / 'dest'), PARAMS)
+    assert manifest.is_current('a.jpg', source)
+    assert manifest.entries['a.jpg']['mtime'] == os.stat(source).st_mtime_ns
+
+
+def test_is_not_current_when_the_content_changed(tmp_path):
+    source, _ = recorded(tmp_path)
+    stat = os.stat(source)
+    write(source, b'lea2')
+    os.utime(source, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    manifest = Manifest(str(tmp_path / 'dest'), PARAMS)
+    assert not manifest.is_current('a.jpg', source)
+
+
+def test_remove_deleted(tmp_path):
+    _, output = recorded(tmp_path)
+
+    manifest = Manifest(str(tmp_path / 'dest'), PARAMS)
+    assert manifest.remove_deleted({'b.jpg'}) == 1
+    assert not os.path.exists(output)
+    assert manifest.entries == {}
+
+
+def test_params_mismatch_drops_the_entries_only(tmp_path):
+    source, output = recorded(tmp_path)
+
+    params = dict(PARAMS, transformation=['blur'])
+    manifest = Manifest(str(tmp_path / 'dest'), params)
+    assert manifest.entries == {}
+    assert not manifest.is_current('a.jpg', source)
+    assert os.path.exists(output)
+
+    manifest.save()
+    manifest = Manifest(str(tmp_path / 'dest'), params)
+    assert manifest.stale == {'a_transfo.png'}
+    assert manifest.remove_stale() == 1
+    assert not os.path.exists(output)
+
+
+def test_remove_stale_keeps_the_outputs_written_again(tmp_path):
+    source, output = recorded(tmp_path)
+
+    manifest = Manifest(str(tmp_path / 'dest'), dict(PARAMS, scale=0.5))
+    manifest.record('a.jpg', source, [output])
+    assert manifest.remove_stale() == 0
+    assert os.path.exists(output)
+
+
+def test_corrupt_manifest_starts_empty(tmp_path):
+    write(tmp_path / 'dest' / '.manifest.json', b'{"params": ')
+
+    manifest = Manifest(str(tmp_path / 'dest'), PARAMS)
+    assert manifest.entries == {}
+    assert manifest.stale == set()
@@ -1,6 +1,7 @@
 #!/bin/env python3
 
 import os
+import shutil
 import matplotlib.image as mplimg
 import numpy as np
 import datetime
@@ -10,6 +11,16 @@ from tensorflow.keras import models, layers
 
 from utils.ArgsHandler import ArgsHandler, ArgsObject, OptionObject
 from utils.ArgsHandler import display_helper
+from utils.image_loader import list_image_labels, load_image_tree
+from utils.image_loader import read_image
+from utils.data_pipeline import make_path_dataset, make_index_dataset
+from utils.data_cache import pack_dataset, open_cache
+from utils.data_split import stratified_split, save_split, load_split
+from utils.data_split import oversample
+from utils.data_augmentation import AUGMENTATIONS
+from utils.train_monitor import TrainingMonitor
+from utils.train_state import TrainingState, read_state, load_state_model
+from utils.model_export import export_tflite, QUANTIZATIONS
 
 
 def save_test_images(x_test, y_test, labels):
@@ -29,34 +40,22 @@ def save_test_images(x_test, y_test, labels):
             print(f"Error while saving {image}: {e}")
 
 
-def list_to_dict(all_image: list) -> dict:
-    """Transform a list of tuple into a dict"""
-    result = {}
-    for path, image in all_image:
-        result[path] = image
-
-    return result
-
-
-def load_all_image(path: str, depth: int) -> list:
-    """Get the max folder size at depth from path"""
-    if depth == 0:
-        all_img = []
-        with os.scandir(path) as it:
-            for entry in it:
-                if entry.is_file():
-                    entry_path = entry.path
-                    img = mplimg.imread(entry_path)
-                    all_img.append(img)
-            print(f"{os.path.basename(path)} done")
-            return [(os.path.basename(path), all_img)]
+def save_test_paths(test_paths, test_labels, labels):
+    """Copy the test files without decoding them"""
+    if os.path.isdir('test_images'):
+        for image in os.listdir('test_images'):
+            try:
+                os.remove('test_images/' + image)
+            except Exception as e:
+                print(f"Error while deleting {image}: {e}")
     else:
-        all_path = []
-        with os.scandir(path) as it:
-            for entry in it:
-                if entry.is_dir():
-                    all_path += load_all_image(entry.path, depth - 1)
-        return all_path
+        os.mkdir('test_images')
+
+    for i, (path, label) in enumerate(zip(test_paths, test_labels)):
+        try:
+            shutil.copyfile(path, f"test_images/{labels[label]}_{i}.JPG")
+        except Exception as e:
+            print(f"Error while saving {path}: {e}")
 
 
 def check_ratio(args_handler, user_input):
@@ -71,13 +70,107 @@ def check_ratio(args_handler, user_input):
     return user_input
 
 
+def check_augmentation(args_handler, u_ipt):
+    """Set the augmentation applied during training"""
+    if u_ipt.get('augmentation') == ['*']:
+        u_ipt['augmentation'] = list(AUGMENTATIONS.keys())
+    elif u_ipt.get('augmentation') is None:
+        if u_ipt.get('oversample'):
+            u_ipt['augmentation'] = ['flip', 'blur', 'brightness',
+                                     'contrast', 'rotate']
+    else:
+        for elem in u_ipt['augmentation']:
+            if elem not in AUGMENTATIONS:
+                raise ValueError(f"Augmentation {elem} is not supported")
+    if not 0 <= u_ipt['augmentation-rate'] <= 1:
+        raise ValueError("Augmentation rate must be between 0 and 1")
+    return u_ipt
+
+
+def check_export(args_handler, u_ipt):
+    """Check the quantization of the exported model"""
+    if u_ipt.get('export') not in (None, *QUANTIZATIONS):
+        raise ValueError(f"Export are {', '.join(QUANTIZATIONS)} \
+not {u_ipt['export']}")
+    return u_ipt
+
+
+def create_model(nb_labels: int):
+    """Create the convolutional model"""
+    model = models.Sequential()
+
+    model.add(tf.keras.Input(shape=(256, 256, 3)))
+    model.add(layers.Conv2D(32, (3, 3), activation='relu'))
+    model.add(layers.MaxPooling2D((2, 2)))
+    model.add(layers.Conv2D(64, (3, 3), activation='relu'))
+    model.add(layers.MaxPooling2D((2, 2)))
+    model.add(layers.Conv2D(64, (3, 3), activation='relu'))
+    model.add(layers.MaxPooling2D((2, 2)))
+    model.add(layers.Conv2D(64, (3, 3), activation='relu'))
+    model.add(layers.MaxPooling2D((2, 2)))
+    model.add(layers.Conv2D(64, (3, 3), activation='relu'))
+    model.add(layers.MaxPooling2D((2, 2)))
+    model.add(layers.Flatten())
+    model.add(layers.Dense(64, activation='relu'))
+    model.add(layers.Dense(nb_labels, activation='softmax'))
+    return model
+
+
+def load_data(path, depth, cache_dir, stream, workers):
+    """Get the class names, the files, their labels and the images backing
+    buffer: a memmap with a cache, None when streaming from the files,
+    an array decoded in memory otherwise"""
+    if cache_dir is not None:
+        pack_dataset(path, depth, cache_dir, workers)
+        images, all_labels, index = open_cache(cache_dir)
+        files = [os.path.join(path, e['path']) for e in index['files']]
+        return index['labels'], files, all_labels, images
+    if stream:
+        return (*list_image_labels(path, depth), None)
+    return load_image_tree(path, depth, workers)
+
+
+def get_split(split_path, path, files, all_labels, labels, ratios, seed):
+    """Reuse the split file if it exists, otherwise make a new stratified
+    split and save it"""
+    if os.path.isfile(split_path):
+        print(f"Reuse split {split_path}")
+        return load_split(split_path, path, files)
+    split = stratified_split(all_labels, *ratios, seed)
+    save_split(split_path, split, path, files, labels, seed)
+    return split
+
+
+def make_dataset(files, all_labels, images, indices, batch_size,
+                 seed=None, initial_epoch=0, epochs=1, augmentation=None):
+    """Create the dataset of the indices from the files or the images.
+    With a seed, the dataset is shuffled and chains the epochs from
+    initial_epoch"""
+    if images is None:
+        return make_path_dataset([files[i] for i in indices],
+                                 all_labels[indices], batch_size, seed,
+                                 initial_epoch, epochs, augmentation)
+    return make_index_dataset(images, all_labels, indices, batch_size, seed,
+                              initial_epoch, epochs, augmentation)
+
+
+def calibration_images(files, images, indices, size, seed):
+    """Yield a random sample of the train images to calibrate the
+    quantization"""
+    rng = np.random.default_rng(seed)
+    sample = rng.choice(indices, min(size, len(indices)), replace=False)
+    for i in np.sort(sample):
+        yield read_image(files[i]) if images is None else images[i]
+
+
 def main():
     """Main"""
     args_handler = ArgsHandler(
         'This program take an image as arguments en display some \
 modifications on it',
         [
-            ArgsObject('image_path', 'The path of the targeted image')
+            ArgsObject('image_path', 'The path of the targeted image',
+                       Optional=True)
         ],
         [
             OptionObject('help', 'Show this help message',
@@ -116,7 +209,72 @@ modifications on it',
             OptionObject('start-weights', 'Initial weights',
                          name='w',
                          expected_type=str,
-                         default=None)
+                         default=None),
+            OptionObject('stream', 'Decode the images lazily by batch \
+instead of loading them all in memory',
+                         name='s',
+                         expected_type=bool,
+                         default=False),
+            OptionObject('batch-size', 'The number of images per batch',
+                         name='b',
+                         expected_type=int,
+                         default=32),
+            OptionObject('cache', 'Folder of the memory-mapped dataset \
+cache, packed or updated before training',
+                         name='c',
+                         expected_type=str,
+                         default=None),
+            OptionObject('workers', 'The number of processes decoding \
+the images',
+                         name='j',
+                         expected_type=int,
+                         default=os.cpu_count()),
+            OptionObject('split', 'The split file to reuse, created if it \
+does not exist',
+                         name='sp',
+                         expected_type=str,
+                         default=None),
+            OptionObject('seed', 'The seed of the split and the shuffle',
+                         name='r',
+                         expected_type=int,
+                         default=None),
+            OptionObject('augmentation', 'The augmentations randomly \
+applied on the train batches, * for all',
+                         name='a',
+                         expected_type=list,
+                         default=None,
+                         check_function=check_augmentation),
+            OptionObject('augmentation-rate', 'The probability to augment \
+each train image',
+                         name='ar',
+                         expected_type=float,
+                         default=0.5),
+            OptionObject('oversample', 'Oversample the smaller classes \
+with augmented images to balance the train set',
+                         name='o',
+                         expected_type=bool,
+                         default=False),
+            OptionObject('profile', 'Record the images/sec, step time, \
+input wait and peak memory of every epoch next to the weights',
+                         name='p',
+                         expected_type=bool,
+                         default=False),
+            OptionObject('resume', 'Resume the interrupted training saved \
+in a weights/<date> folder, with its options',
+                         name='rs',
+                         expected_type=str,
+                         default=None),
+            OptionObject('export', 'Also export a post-training quantized \
+TFLite model: int8, float16 or dynamic',
+                         name='x',
+                         expected_type=str,
+                         default=None,
+                         check_function=check_export),
+            OptionObject('calibration-size', 'The number of train images \
+calibrating the int8 quantization',
+                         name='cs',
+                         expected_type=int,
+                         default=200)
         ],
         """"""
     )
@@ -130,95 +288,117 @@ modifications on it',
         print(e)
         return
 
-    path = user_input['args'][0]
-    depth = user_input['depth']
-
-    try:
-        all_image = load_all_image(path, depth)
-        all_image_dict = list_to_dict(all_image)
-    except Exception as e:
-        print(e)
-        return
-
-    model = models.Sequential()
-
-    model.add(tf.keras.Input(shape=(256, 256, 3)))
-    model.add(layers.Conv2D(32, (3, 3), activation='relu'))
-    model.add(layers.MaxPooling2D((2, 2)))
-    model.add(layers.Conv2D(64, (3, 3), activation='relu'))
-    model.add(layers.MaxPooling2D((2, 2)))
-    model.add(layers.Conv2D(64, (3, 3), activation='relu'))
-    model.add(layers.MaxPooling2D((2, 2)))
-    model.add(layers.Conv2D(64, (3, 3), activation='relu'))
-    model.add(layers.MaxPooling2D((2, 2)))
-    model.add(layers.Conv2D(64, (3, 3), activation='relu'))
-    model.add(layers.MaxPooling2D((2, 2)))
-    model.add(layers.Flatten())
-    model.add(layers.Dense(64, activation='relu'))
-    model.add(layers.Dense(len(all_image_dict.keys()), activation='softmax'))
-    model.summary()
-
-    if 'start-weights' in user_input:
+    state = None
+    if user_input.get('resume'):
         try:
-            weights = user_input['start-weights']
-            if (weights):
-                model.load_weights(weights)
+            weights_dir = user_input['resume']
+            state = read_state(weights_dir)
+            user_input = state['options']
         except Exception as e:
-            print(f"Error while loading weights: {e}")
+            print(f"Error while loading training state: {e}")
             return
+    elif len(user_input['args']) != 1:
+        print(f"Expected 1 arguments, got {len(user_input['args'])}.")
+        return
+    else:
+        date = f"{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}"
+        weights_dir = './weights/' + date
+        user_input.setdefault('split', weights_dir + '/split.json')
+        user_input.setdefault('seed', int(np.random.randint(2**31)))
 
+    path = user_input['args'][0]
+    depth = user_input['depth']
     valid_ratio = user_input['validation-ratio']
     test_ratio = user_input['test-ratio']
     model_path = user_input['model']
+    batch_size = user_input['batch-size']
+    workers = user_input['workers']
+    epochs = user_input['epochs']
+    split_path = user_input['split']
+    seed = user_input['seed']
+    initial_epoch = 0 if state is None else state['epoch']
 
-    size = len(next(iter(all_image_dict.values())))
-    trn_size = int(valid_ratio * size)
-    test_size = int(test_ratio * size)
-
-    x_train, x_valid, x_test = [], [], []
-    y_train, y_valid, y_test = [], [], []
-
-    x_rnd = [i for i in range(0, size)]
-    np.random.shuffle(x_rnd)
+    tf.keras.utils.set_random_seed(seed)
+    tf.config.experimental.enable_op_determinism()
 
     try:
-        for i, value in enumerate(all_image_dict.values()):
-            data = np.array(value)[x_rnd[:trn_size]]
-            x_train.extend(data)
-            y_train.extend([i] * (trn_size))
-            test_data = np.array(value)[x_rnd[trn_size:trn_size + test_size]]
-            x_test.extend(test_data)
-            y_test.extend([i] * test_size)
-            x_valid.extend(np.array(value)[x_rnd[trn_size + test_size:]])
-            y_valid.extend([i] * (size - trn_size - test_size))
+        labels, files, all_labels, images = load_data(
+            path, depth, user_input.get('cache'), user_input['stream'],
+            workers)
+        os.makedirs(weights_dir, exist_ok=True)
+        split = get_split(split_path, path, files, all_labels, labels,
+                          (valid_ratio, test_ratio), seed)
     except Exception as e:
-        print(f"Error while splitting data: {e}")
+        print(f"Error while loading data: {e}")
         return
 
-    labels = list(all_image_dict.keys())
-
-    if x_test is not []:
-        save_test_images(x_test, y_test, labels)
+    test = split['test']
+    if len(test) > 0 and state is None:
+        if images is None:
+            save_test_paths([files[i] for i in test], all_labels[test],
+                            labels)
+        else:
+            save_test_images((images[i] for i in test), all_labels[test],
+                             labels)
+
+    train = split['train']
+    if user_input['oversample']:
+        train = oversample(train, all_labels, seed)
+    augmentation = None
+    if user_input.get('augmentation'):
+        augmentation = (user_input['augmentation'],
+                        user_input['augmentation-rate'])
+    train_data = make_dataset(files, all_labels, images, train, batch_size,
+                              seed, initial_epoch, epochs, augmentation)
+    valid_data = make_dataset(files, all_labels, images, split['valid'],
+                              batch_size)
+
+    if state is None:
+        model = create_model(len(labels))
+        model.summary()
+
+        if 'start-weights' in user_input:
+            try:
+                weights = user_input['start-weights']
+                if (weights):
+                    model.load_weights(weights)
+            except Exception as e:
+                print(f"Error while loading weights: {e}")
+                return
 
-    loss = tf.keras.losses.SparseCategoricalCrossentropy()
-    model.compile(optimizer='adam', loss=loss, metrics=['acc'])
+        loss = tf.keras.losses.SparseCategoricalCrossentropy()
+        model.compile(optimizer='adam', loss=loss, metrics=['acc'])
+    else:
+        try:
+            model = load_state_model(weights_dir)
+        except Exception as e:
+            print(f"Error while loading training state: {e}")
+            return
+        print(f"Resume training at epoch {initial_epoch + 1}")
 
     early_stop = tf.keras.callbacks.EarlyStopping(monitor='val_loss',
                                                   patience=3,
                                                   start_from_epoch=7)
 
-    date = f"{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}"
-    filepath = './weights/' + date + '/{epoch:02d}-{val_loss:.2f}.weights.h5'
+    filepath = weights_dir + '/{epoch:02d}-{val_loss:.2f}.weights.h5'
     checkpoint = tf.keras.callbacks.ModelCheckpoint(filepath=filepath,
                                                     save_weights_only=True,
                                                     monitor='val_loss')
 
-    valid_data = np.array(x_valid), np.array(y_valid)
-    model.fit(np.array(x_train),
-              np.array(y_train),
+    callbacks = [early_stop,
+                 TrainingState(weights_dir, user_input, early_stop, state),
+                 checkpoint]
+    if user_input['profile']:
+        monitor = TrainingMonitor(weights_dir)
+        train_data = monitor.instrument(train_data)
+        callbacks.append(monitor)
+
+    model.fit(train_data,
               validation_data=valid_data,
-              epochs=user_input['epochs'],
-              callbacks=[early_stop, checkpoint])
+              epochs=epochs,
+              initial_epoch=initial_epoch,
+              steps_per_epoch=-(-len(train) // batch_size),
+              callbacks=callbacks)
     try:
         model.save(model_path)
         pickle.dump(labels, open('labels.pkl', 'wb'))
@@ -226,6 +406,18 @@ modifications on it',
         print(e)
         return
 
+    quantization = user_input.get('export')
+    if quantization:
+        lite_path = f"{os.path.splitext(model_path)[0]}_{quantization}.tflite"
+        calibration = calibration_images(files, images, split['train'],
+                                         user_input['calibration-size'],
+                                         seed)
+        try:
+            size = export_tflite(model, lite_path, quantization, calibration)
+            print(f"Model exported to {lite_path} ({size / 2**20:.2f} MB)")
+        except Exception as e:
+            print(f"Error while exporting model: {e}")
+
 
 if __name__ == "__main__":
     main()
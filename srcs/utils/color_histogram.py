@@ -0,0 +1,101 @@
+import cv2
+import numpy as np
+
+
+# Rows of the histograms, in the order of imgt_color_histogram, with the
+# channel of the stacked b, g, r, l, a, b, h, s, v image they count
+HISTOGRAMS = (
+    ('blue_frequencies', 0),
+    ('blue-yellow_frequencies', 5),
+    ('green_frequencies', 1),
+    ('green-magenta_frequencies', 4),
+    ('hue_frequencies', 6),
+    ('lightness_frequencies', 3),
+    ('red_frequencies', 2),
+    ('saturation_frequencies', 7),
+    ('value_frequencies', 8),
+)
+NB_BINS = 256
+
+# Bin labels given by pcv.analyze.color
+RGB_LABELS = list(range(NB_BINS))
+DIVERGING_LABELS = list(range(-128, 128))
+PERCENT_LABELS = [round((i / 255) * 100, 2) for i in range(NB_BINS)]
+HUE_LABELS = [i * 2 + 1 for i in range(180)]
+HISTOGRAM_LABELS = {
+    'blue_frequencies': RGB_LABELS,
+    'blue-yellow_frequencies': DIVERGING_LABELS,
+    'green_frequencies': RGB_LABELS,
+    'green-magenta_frequencies': DIVERGING_LABELS,
+    'hue_frequencies': HUE_LABELS,
+    'lightness_frequencies': PERCENT_LABELS,
+    'red_frequencies': RGB_LABELS,
+    'saturation_frequencies': PERCENT_LABELS,
+    'value_frequencies': PERCENT_LABELS,
+}
+
+
+def analysis_mask(mask: np.ndarray) -> np.ndarray:
+    """Return the pixels pcv.analyze.color keeps for a mask: the 255
+    pixels of a two valued mask, the 1 pixels otherwise"""
+    if len(np.unique(mask)) == 2:
+        return mask == 255
+    return mask == 1
+
+
+def stack_channels(images: np.ndarray) -> np.ndarray:
+    """Stack the b, g, r, l, a, b, h, s, v channels of (N, H, W, 3)
+    images into (N, H, W, 9), reading them as BGR like plantcv does"""
+    n, h, w, _ = images.shape
+    flat = images.reshape(n * h, w, 3)
+    lab = cv2.cvtColor(flat, cv2.COLOR_BGR2LAB)
+    hsv = cv2.cvtColor(flat, cv2.COLOR_BGR2HSV)
+    return np.concatenate([flat, lab, hsv], axis=-1).reshape(n, h, w, 9)
+
+
+def color_histograms_batch(images: np.ndarray,
+                           masks: np.ndarray) -> np.ndarray:
+    """Compute the nine color histograms of (N, H, W, 3) images in the
+    (N, H, W) masks, as percents of the masked pixels in an
+    (N, 9, 256) float array whose rows follow HISTOGRAMS"""
+    images = np.asarray(images)
+    channels = stack_channels(images)
+    order = [channel for _, channel in HISTOGRAMS]
+    keep = np.stack([analysis_mask(mask) for mask in masks])
+    n = len(images)
+
+    if images.dtype == np.uint8:
+        samples = np.nonzero(keep)[0]
+        values = channels[keep][:, order].astype(np.int64)
+        rows = samples[:, None] * len(order) + np.arange(len(order))
+        counts = np.bincount((rows * NB_BINS + values).ravel(),
+                             minlength=n * len(order) * NB_BINS)
+        counts = counts.reshape(n, len(order), NB_BINS).astype(np.float64)
+    else:
+        counts = np.zeros((n, len(order), NB_BINS))
+        for i in range(n):
+            pixels = channels[i][keep[i]]
+            for row, channel in enumerate(order):
+                counts[i, row] = np.histogram(pixels[:, channel],
+                                              bins=NB_BINS,
+                                              range=(0, 255))[0]
+
+    # An empty mask gives histograms of zeros rather than NaN
+    total = counts.sum(axis=-1, keepdims=True)
+    return np.divide(counts * 100, total, out=np.zeros_like(counts),
+                     where=total > 0)
+
+
+def color_histograms(img: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    """Compute the (9, 256) color histograms of one image"""
+    return color_histograms_batch(img[None], mask[None])[0]
+
+
+def histogram_series(histograms: np.ndarray) -> dict:
+    """Return the (labels, values) series of each histogram, as
+    pcv.analyze.color stores them in its observations"""
+    series = {}
+    for (key, _), values in zip(HISTOGRAMS, histograms):
+        labels = HISTOGRAM_LABELS[key]
+        series[key] = (labels, values[:len(labels)].tolist())
+    return series
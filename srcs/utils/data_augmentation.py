@@ -1,7 +1,7 @@
+import random
+import functools
 import numpy as np
 import skimage
-import augly.image as imaugs
-import random
 
 
 def check_image(func):
@@ -12,108 +12,371 @@ def check_image(func):
     return inner
 
 
+def to_uint8(image: np.ndarray) -> np.ndarray:
+    """Convert an augmented image back to uint8 RGB pixels"""
+    image = np.asarray(image)
+    if image.ndim == 3:
+        image = image[..., :3]
+    if image.dtype != np.uint8:
+        if image.max() <= 1.0:
+            image = image * 255
+        image = np.clip(np.round(image), 0, 255).astype(np.uint8)
+    return image
+
+
+def random_factors(count: int, factor: float,
+                   rng: np.random.Generator = None) -> np.ndarray:
+    """Draw count factors uniformly in [1, 1 + factor), from rng or
+    from the random module"""
+    if rng is None:
+        return np.array([random.random() * factor + 1
+                         for _ in range(count)], dtype=np.float32)
+    return (rng.random(count) * factor + 1).astype(np.float32)
+
+
+def bilinear_sample(images: np.ndarray, rows: np.ndarray,
+                    cols: np.ndarray) -> np.ndarray:
+    """Sample each image of a (N, H, W, C) uint8 batch at the float
+    coordinates rows, cols of shape (H', W') with bilinear interpolation.
+    The pixels outside of the images are black"""
+    height, width = images.shape[1:3]
+    row0 = np.floor(rows).astype(np.intp)
+    col0 = np.floor(cols).astype(np.intp)
+    drow = (rows - row0).astype(np.float32)
+    dcol = (cols - col0).astype(np.float32)
+
+    out = np.zeros((len(images), *rows.shape, images.shape[3]),
+                   dtype=np.float32)
+    for row, row_weight in ((row0, 1 - drow), (row0 + 1, drow)):
+        for col, col_weight in ((col0, 1 - dcol), (col0 + 1, dcol)):
+            inside = (row >= 0) & (row < height) & (col >= 0) & (col < width)
+            weight = np.where(inside, row_weight * col_weight, 0)
+            out += images[:, np.clip(row, 0, height - 1),
+                          np.clip(col, 0, width - 1)] * weight[..., None]
+    return np.clip(np.round(out), 0, 255).astype(np.uint8)
+
+
+def transform_map(transform, shape: tuple, src_shape: tuple = None) -> tuple:
+    """Coordinates in the source image of each pixel of an image of
+    shape, through the inverse map transform of skimage.transform.warp.
+    The output is resized from src_shape to shape first if given"""
+    rows, cols = np.indices(shape, dtype=np.float64)
+    if src_shape is not None:
+        rows = (rows + 0.5) * src_shape[0] / shape[0] - 0.5
+        cols = (cols + 0.5) * src_shape[1] / shape[1] - 0.5
+    src = transform(np.column_stack([cols.ravel(), rows.ravel()]))
+    src = np.nan_to_num(src, nan=-1, posinf=-1, neginf=-1)
+    return src[:, 1].reshape(shape), src[:, 0].reshape(shape)
+
+
+@functools.lru_cache(maxsize=32)
+def rotate_map(rows: int, cols: int, angle: float) -> tuple:
+    """Source coordinates of skimage.transform.rotate, around the center"""
+    out_rows, out_cols = np.indices((rows, cols), dtype=np.float64)
+    center_row, center_col = rows / 2 - 0.5, cols / 2 - 0.5
+    cos, sin = np.cos(np.deg2rad(angle)), np.sin(np.deg2rad(angle))
+    out_rows, out_cols = out_rows - center_row, out_cols - center_col
+    return (sin * out_cols + cos * out_rows + center_row,
+            cos * out_cols - sin * out_rows + center_col)
+
+
+@functools.lru_cache(maxsize=32)
+def skew_map(rows: int, cols: int, skew: float) -> tuple:
+    """Source coordinates of the horizontal skew of augly"""
+    out_rows, out_cols = np.indices((rows, cols), dtype=np.float64)
+    return out_rows, out_cols + skew * (out_rows + 0.5 - rows / 2)
+
+
+@functools.lru_cache(maxsize=32)
+def shear_map(rows: int, cols: int, shear: float) -> tuple:
+    """Source coordinates of the skimage affine shear"""
+    t_form = skimage.transform.AffineTransform(shear=shear)
+    return transform_map(t_form.inverse, (rows, cols))
+
+
+@functools.lru_cache(maxsize=32)
+def crop_map(rows: int, cols: int, factor: float) -> tuple:
+    """Source coordinates of the crop of factor on each side resized
+    back to the whole image"""
+    top, bottom = int(factor * rows), int((1 - factor) * rows)
+    left, right = int(factor * cols), int((1 - factor) * cols)
+    out_rows, out_cols = np.indices((rows, cols), dtype=np.float64)
+    out_rows = top + (out_rows + 0.5) * (bottom - top) / rows - 0.5
+    out_cols = left + (out_cols + 0.5) * (right - left) / cols - 0.5
+    return (np.clip(out_rows, top, bottom - 1),
+            np.clip(out_cols, left, right - 1))
+
+
+@functools.lru_cache(maxsize=8)
+def distortion_map(rows: int, cols: int) -> tuple:
+    """Source coordinates of the sinusoidal piecewise affine distortion,
+    resized back to the whole image"""
+    src_cols = np.linspace(0, cols, 20)
+    src_rows = np.linspace(0, rows, 10)
+    src_rows, src_cols = np.meshgrid(src_rows, src_cols)
+    src = np.dstack([src_cols.flat, src_rows.flat])[0]
+
+    # add sinusoidal oscillation to row coordinates
+    dst_rows = src[:, 1] - np.sin(np.linspace(0, 3 * np.pi, src.shape[0])) * 20
+    dst_cols = src[:, 0]
+    dst_rows *= 1.5
+    dst_rows -= 1.5 * 50
+    dst = np.vstack([dst_cols, dst_rows]).T
+
+    tform = skimage.transform.PiecewiseAffineTransform()
+    tform.estimate(src, dst)
+
+    out_rows = rows - 1.5 * 50
+    return transform_map(tform, (rows, cols), (out_rows, cols))
+
+
+@functools.lru_cache(maxsize=32)
+def projective_map(rows: int, cols: int) -> tuple:
+    """Source coordinates of the fixed projective transform"""
+    matrix = np.array([[1, -0.5, 100],
+                       [0.1, 0.9, 50],
+                       [0.0015, 0.0015, 1]])
+    tform = skimage.transform.ProjectiveTransform(matrix=matrix)
+    return transform_map(tform.inverse, (rows, cols))
+
+
+def batch_flip(images: np.ndarray, rng=None) -> np.ndarray:
+    """Flip a (N, H, W, C) uint8 batch horizontally"""
+    return np.ascontiguousarray(images[:, :, ::-1])
+
+
+def batch_rotate(images: np.ndarray, angle: float = 25,
+                 rng=None) -> np.ndarray:
+    """Rotate a (N, H, W, C) uint8 batch"""
+    return bilinear_sample(images, *rotate_map(*images.shape[1:3], angle))
+
+
+def batch_skew(images: np.ndarray, skew: float = 2, rng=None) -> np.ndarray:
+    """Skew a (N, H, W, C) uint8 batch"""
+    return bilinear_sample(images, *skew_map(*images.shape[1:3], skew))
+
+
+def batch_shear(images: np.ndarray, shear: float = 0.5,
+                rng=None) -> np.ndarray:
+    """Shear a (N, H, W, C) uint8 batch"""
+    return bilinear_sample(images, *shear_map(*images.shape[1:3], shear))
+
+
+def batch_crop(images: np.ndarray, factor: float = 0.2,
+               rng=None) -> np.ndarray:
+    """Crop a (N, H, W, C) uint8 batch"""
+    factor = min(max(factor, 0), 0.4)
+    return bilinear_sample(images, *crop_map(*images.shape[1:3], factor))
+
+
+def batch_distortion(images: np.ndarray, rng=None) -> np.ndarray:
+    """Distort a (N, H, W, C) uint8 batch"""
+    return bilinear_sample(images, *distortion_map(*images.shape[1:3]))
+
+
+def batch_projective(images: np.ndarray, rng=None) -> np.ndarray:
+    """Project a (N, H, W, C) uint8 batch"""
+    return bilinear_sample(images, *projective_map(*images.shape[1:3]))
+
+
+def gaussian_pass(images: np.ndarray, kernels: np.ndarray,
+                  axis: int) -> np.ndarray:
+    """Convolve each image of a (N, H, W, C) batch along axis with its
+    own 1-D kernel of the (N, K) kernels, extending the edges"""
+    radius = kernels.shape[1] // 2
+    pad = [(0, 0)] * 4
+    pad[axis] = (radius, radius)
+    padded = np.pad(images, pad, mode='edge')
+    size = images.shape[axis]
+
+    out = np.zeros(images.shape, dtype=np.float32)
+    window = [slice(None)] * 4
+    for k in range(kernels.shape[1]):
+        window[axis] = slice(k, k + size)
+        out += padded[tuple(window)] * kernels[:, k, None, None, None]
+    return out
+
+
+def batch_blur(images: np.ndarray, factor: float = 3.0,
+               rng: np.random.Generator = None) -> np.ndarray:
+    """Blur each image of a (N, H, W, C) uint8 batch with a gaussian of
+    a random radius in [1, 1 + factor)"""
+    sigmas = random_factors(len(images), factor, rng)
+    radius = int(np.ceil(3 * sigmas.max(initial=1)))
+    offsets = np.arange(-radius, radius + 1, dtype=np.float32)
+    kernels = np.exp(-offsets ** 2 / (2 * sigmas[:, None] ** 2))
+    kernels /= kernels.sum(axis=1, keepdims=True)
+
+    out = gaussian_pass(gaussian_pass(images, kernels, 1), kernels, 2)
+    return np.clip(np.round(out), 0, 255).astype(np.uint8)
+
+
+def color_channels(images: np.ndarray) -> int:
+    """Number of color channels of a batch, the others are alpha"""
+    return 3 if images.shape[3] >= 3 else 1
+
+
+def batch_brightness(images: np.ndarray, factor: float = 2.5,
+                     rng: np.random.Generator = None) -> np.ndarray:
+    """Change the brightness of each image of a (N, H, W, C) uint8 batch
+    by a random factor in [1, 1 + factor). The alpha channel is kept"""
+    factors = random_factors(len(images), factor, rng)
+    colors = color_channels(images)
+    out = images.copy()
+    out[..., :colors] = np.clip(images[..., :colors]
+                                * factors[:, None, None, None], 0, 255)
+    return out
+
+
+def batch_contrast(images: np.ndarray, factor: float = 3.0,
+                   rng: np.random.Generator = None) -> np.ndarray:
+    """Change the contrast of each image of a (N, H, W, C) uint8 batch
+    by a random factor in [1, 1 + factor), around its mean grey level
+    like PIL.ImageEnhance.Contrast. The alpha channel is kept"""
+    factors = random_factors(len(images), factor, rng)[:, None, None, None]
+    colors = color_channels(images)
+    if colors == 3:
+        pixels = images[..., :3].astype(np.uint32)
+        grey = (pixels[..., 0] * 19595 + pixels[..., 1] * 38470
+                + pixels[..., 2] * 7471 + 0x8000) >> 16
+    else:
+        grey = images[..., 0]
+    means = np.floor(grey.mean(axis=(1, 2)) + 0.5).astype(np.float32)
+    means = means[:, None, None, None]
+    out = images.copy()
+    out[..., :colors] = np.clip(
+        means + factors * (images[..., :colors] - means), 0, 255)
+    return out
+
+
+def apply_one(batch_function, image: np.ndarray, **kwargs) -> np.ndarray:
+    """Apply a batch augmentation on one image as a batch of one. The
+    image keeps its channels, dtype and range: float images in [0, 1]
+    are augmented in 8-bit and scaled back"""
+    image = np.asarray(image)
+    pixels, scale = image, 1
+    if image.dtype != np.uint8:
+        scale = 255 if image.max(initial=0) <= 1 else 1
+        pixels = np.clip(np.round(image * scale), 0, 255).astype(np.uint8)
+    batch = pixels.reshape(1, *pixels.shape[:2], -1)
+    out = batch_function(batch, **kwargs)[0].reshape(image.shape)
+    if image.dtype != np.uint8:
+        out = (out / scale).astype(image.dtype)
+    return out
+
+
 @check_image
 def image_flip(image: np.ndarray) -> np.ndarray:
     """Flip an image"""
-    return imaugs.aug_np_wrapper(image, imaugs.hflip)
+    return apply_one(batch_flip, image)
 
 
 @check_image
 def image_rotate(image: np.ndarray, angle: float = 25) -> np.ndarray:
     """Rotate an image"""
-    return skimage.transform.rotate(image, angle)
+    return apply_one(batch_rotate, image, angle=angle)
 
 
 @check_image
 def image_skew(image: np.ndarray, skew: float = 2) -> np.ndarray:
     """Skew an image"""
-    return imaugs.aug_np_wrapper(image, imaugs.skew, skew_factor=skew)
+    return apply_one(batch_skew, image, skew=skew)
 
 
 @check_image
 def image_shear(image: np.ndarray, shear: float = 0.5) -> np.ndarray:
     """Shear an image"""
-    t_form = skimage.transform.AffineTransform(shear=shear)
-    return skimage.transform.warp(image, t_form.inverse)
+    return apply_one(batch_shear, image, shear=shear)
 
 
 @check_image
 def image_crop(image: np.ndarray, factor: float = 0.2) -> np.ndarray:
     """Crop an image"""
-    if factor > 0.4:
-        factor = 0.4
-    elif factor < 0:
-        factor = 0
-
-    crop_img = imaugs.aug_np_wrapper(image, imaugs.crop,
-                                     x1=factor,
-                                     x2=1-factor,
-                                     y1=factor,
-                                     y2=1-factor
-                                     )
-    crop_img = imaugs.aug_np_wrapper(crop_img,
-                                     imaugs.resize,
-                                     width=image.shape[1],
-                                     height=image.shape[0]
-                                     )
-    return crop_img
+    return apply_one(batch_crop, image, factor=factor)
 
 
 @check_image
 def image_distortion(image: np.ndarray) -> np.ndarray:
     """Distort an image"""
-    rows, cols = image.shape[0], image.shape[1]
-
-    src_cols = np.linspace(0, cols, 20)
-    src_rows = np.linspace(0, rows, 10)
-    src_rows, src_cols = np.meshgrid(src_rows, src_cols)
-    src = np.dstack([src_cols.flat, src_rows.flat])[0]
-
-    # add sinusoidal oscillation to row coordinates
-    dst_rows = src[:, 1] - np.sin(np.linspace(0, 3 * np.pi, src.shape[0])) * 20
-    dst_cols = src[:, 0]
-    dst_rows *= 1.5
-    dst_rows -= 1.5 * 50
-    dst = np.vstack([dst_cols, dst_rows]).T
-
-    tform = skimage.transform.PiecewiseAffineTransform()
-    tform.estimate(src, dst)
-
-    out_rows = image.shape[0] - 1.5 * 50
-    out_cols = cols
-    out = skimage.transform.warp(image,
-                                 tform,
-                                 output_shape=(out_rows, out_cols))
-    out = skimage.transform.resize(out, (rows, cols))
-    return out
+    return apply_one(batch_distortion, image)
 
 
 @check_image
-def image_blur(image: np.ndarray, factor: float = 3.0) -> np.ndarray:
+def image_blur(image: np.ndarray, factor: float = 3.0,
+               rng: np.random.Generator = None) -> np.ndarray:
     """Blur an image"""
-    factor = random.random() * factor + 1
-    return imaugs.aug_np_wrapper(image, imaugs.blur, radius=factor)
+    return apply_one(batch_blur, image, factor=factor, rng=rng)
 
 
 @check_image
-def image_brightness(image: np.ndarray, factor: float = 2.5) -> np.ndarray:
+def image_brightness(image: np.ndarray, factor: float = 2.5,
+                     rng: np.random.Generator = None) -> np.ndarray:
     """Change brightness of an image"""
-    factor = random.random() * factor + 1
-    return imaugs.aug_np_wrapper(image, imaugs.brightness, factor=factor)
+    return apply_one(batch_brightness, image, factor=factor, rng=rng)
 
 
 @check_image
-def image_contrast(image: np.ndarray, factor: float = 3.0) -> np.ndarray:
+def image_contrast(image: np.ndarray, factor: float = 3.0,
+                   rng: np.random.Generator = None) -> np.ndarray:
     """Change contrast of an image"""
-    factor = random.random() * factor + 1
-    return imaugs.aug_np_wrapper(image, imaugs.contrast, factor=factor)
+    return apply_one(batch_contrast, image, factor=factor, rng=rng)
 
 
 @check_image
 def image_projective(image: np.ndarray) -> np.ndarray:
     """Project an image"""
-    matrix = np.array([[1, -0.5, 100],
-                       [0.1, 0.9, 50],
-                       [0.0015, 0.0015, 1]])
-    tform = skimage.transform.ProjectiveTransform(matrix=matrix)
-    return skimage.transform.warp(image, tform.inverse)
+    return apply_one(batch_projective, image)
+
+
+AUGMENTATIONS = {
+    'flip': image_flip,
+    'rotate': image_rotate,
+    'skew': image_skew,
+    'shear': image_shear,
+    'crop': image_crop,
+    'distortion': image_distortion,
+    'blur': image_blur,
+    'brightness': image_brightness,
+    'contrast': image_contrast,
+    'projective': image_projective
+}
+
+# Same augmentations on (N, H, W, C) uint8 batches, called as
+# function(images, rng=None)
+BATCH_AUGMENTATIONS = {
+    'flip': batch_flip,
+    'rotate': batch_rotate,
+    'skew': batch_skew,
+    'shear': batch_shear,
+    'crop': batch_crop,
+    'distortion': batch_distortion,
+    'blur': batch_blur,
+    'brightness': batch_brightness,
+    'contrast': batch_contrast,
+    'projective': batch_projective
+}
+
+
+def augment_batch(images: np.ndarray,
+                  transformations: list,
+                  rate: float = 0.5,
+                  rng: np.random.Generator = None) -> np.ndarray:
+    """Apply a random augmentation among transformations to each image
+    of a (N, H, W, 3) uint8 batch with the probability rate. The images
+    sharing an augmentation are transformed as one batch. Draws come
+    from rng, or from the random module without it"""
+    out = np.array(images, copy=True)
+    if rng is None:
+        chosen = [random.choice(transformations)
+                  if random.random() < rate else None for _ in out]
+    else:
+        augmented = rng.random(len(out)) < rate
+        picks = rng.integers(len(transformations), size=len(out))
+        chosen = [transformations[pick] if aug else None
+                  for aug, pick in zip(augmented, picks)]
+
+    for name in dict.fromkeys(transformations):
+        indices = [i for i, transfo in enumerate(chosen) if transfo == name]
+        if indices:
+            out[indices] = BATCH_AUGMENTATIONS[name](out[indices], rng=rng)
+    return out
@@ -0,0 +1,112 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+from utils.image_loader import list_image_paths, load_images, IMG_SIZE
+
+
+CACHE_IMAGES = 'images.npy'
+CACHE_LABELS = 'labels.npy'
+CACHE_INDEX = 'index.json'
+
+
+def list_entries(path: str, depth: int) -> tuple:
+    """List the files of the tree with their stat used to detect changes.
+    Return the class names and the file entries"""
+    all_class = list_image_paths(path, depth)
+    entries = []
+    for label, (_, paths) in enumerate(all_class):
+        for file_path in paths:
+            stat = os.stat(file_path)
+            entries.append({'path': os.path.relpath(file_path, path),
+                            'size': stat.st_size,
+                            'mtime': stat.st_mtime_ns,
+                            'label': label})
+    return [name for name, _ in all_class], entries
+
+
+def tree_fingerprint(names: list, entries: list) -> str:
+    """Hash the class names and the file entries of a tree"""
+    sha = hashlib.sha1()
+    sha.update(json.dumps(names).encode())
+    for entry in entries:
+        sha.update(f"{entry['path']}\0{entry['size']}\0{entry['mtime']}\0\
+{entry['label']}\n".encode())
+    return sha.hexdigest()
+
+
+def read_index(cache_dir: str) -> dict:
+    """Read the index of a cache, None if there is no valid cache"""
+    try:
+        with open(os.path.join(cache_dir, CACHE_INDEX)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def pack_dataset(path: str,
+                 depth: int,
+                 cache_dir: str,
+                 workers: int = None) -> dict:
+    """Write the decoded images and labels of the tree in a memory-mapped
+    cache. Files already in the cache with the same size and mtime are
+    copied from it, only new or changed files are decoded.
+    Return the index of the cache"""
+    names, entries = list_entries(path, depth)
+    fingerprint = tree_fingerprint(names, entries)
+
+    old_index = read_index(cache_dir)
+    if old_index is not None and old_index['fingerprint'] == fingerprint:
+        return old_index
+
+    os.makedirs(cache_dir, exist_ok=True)
+    images_path = os.path.join(cache_dir, CACHE_IMAGES)
+    old_rows, old_images = {}, None
+    if old_index is not None and os.path.isfile(images_path):
+        old_images = np.load(images_path, mmap_mode='r')
+        old_rows = {(e['path'], e['size'], e['mtime']): row
+                    for row, e in enumerate(old_index['files'])}
+
+    tmp_path = os.path.join(cache_dir, 'images.tmp.npy')
+    images = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8,
+                                       shape=(len(entries), *IMG_SIZE, 3))
+    changed_paths, changed_rows = [], []
+    for row, entry in enumerate(entries):
+        key = (entry['path'], entry['size'], entry['mtime'])
+        if key in old_rows:
+            images[row] = old_images[old_rows[key]]
+        else:
+            changed_paths.append(os.path.join(path, entry['path']))
+            changed_rows.append(row)
+    load_images(changed_paths, workers, out=images, rows=changed_rows)
+    decoded = len(changed_rows)
+    images.flush()
+    del images, old_images
+    os.replace(tmp_path, images_path)
+
+    labels = np.array([e['label'] for e in entries], dtype=np.int32)
+    np.save(os.path.join(cache_dir, CACHE_LABELS), labels)
+
+    index = {'source': os.path.abspath(path),
+             'depth': depth,
+             'fingerprint': fingerprint,
+             'labels': names,
+             'files': entries}
+    with open(os.path.join(cache_dir, CACHE_INDEX), 'w') as f:
+        json.dump(index, f)
+    print(f"{decoded} images decoded, {len(entries) - decoded} reused")
+    return index
+
+
+def open_cache(cache_dir: str) -> tuple:
+    """Open a cache without copying it in memory.
+    Return the images memmap, the labels and the index"""
+    index = read_index(cache_dir)
+    if index is None:
+        raise ValueError(f"No dataset cache in {cache_dir}")
+    images = np.load(os.path.join(cache_dir, CACHE_IMAGES), mmap_mode='r')
+    labels = np.load(os.path.join(cache_dir, CACHE_LABELS))
+    if len(images) != len(index['files']) or len(labels) != len(images):
+        raise ValueError(f"Dataset cache in {cache_dir} is corrupted")
+    return images, labels, index
@@ -0,0 +1,132 @@
+import numpy as np
+import tensorflow as tf
+
+from utils.image_loader import IMG_SIZE
+from utils.data_augmentation import augment_batch
+
+
+def decode_image(path, label):
+    """Read, decode and resize one image of the dataset"""
+    raw = tf.io.read_file(path)
+    img = tf.io.decode_image(raw, channels=3, expand_animations=False)
+    img = tf.image.resize(img, IMG_SIZE)
+    return tf.cast(tf.round(img), tf.uint8), label
+
+
+def set_shape(x, y):
+    """Restore the static shape lost by numpy functions"""
+    x.set_shape((None, *IMG_SIZE, 3))
+    y.set_shape((None,))
+    return x, y
+
+
+def augment_dataset(dataset: tf.data.Dataset,
+                    augmentation: tuple,
+                    seed: int = None,
+                    epoch=0) -> tf.data.Dataset:
+    """Apply the random augmentation stage on the uint8 batches.
+    augmentation is a (transformations, rate) tuple. With a seed, batch i
+    of epoch draws from a generator keyed on (seed, epoch, i), so the
+    augmentations do not depend on the order the parallel calls run in"""
+    transformations, rate = augmentation
+
+    def augment_numpy(batch, epoch, index):
+        rng = None if seed is None \
+            else np.random.default_rng([seed, int(epoch), int(index)])
+        return augment_batch(batch, transformations, rate, rng)
+
+    def augment(index, batch):
+        x, y = batch
+        x = tf.numpy_function(augment_numpy, [x, epoch, index], tf.uint8)
+        return x, y
+
+    dataset = dataset.enumerate().map(augment,
+                                      num_parallel_calls=tf.data.AUTOTUNE)
+    return dataset.map(set_shape)
+
+
+def finish_dataset(dataset: tf.data.Dataset) -> tf.data.Dataset:
+    """Convert the uint8 batches to the float input of the model and
+    prefetch"""
+    dataset = dataset.map(lambda x, y: (tf.cast(x, tf.float32), y))
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def epoch_dataset(size: int,
+                  make_batches,
+                  seed: int = None,
+                  initial_epoch: int = 0,
+                  epochs: int = 1,
+                  augmentation: tuple = None) -> tf.data.Dataset:
+    """Create the batches of the positions 0..size with make_batches.
+    With a seed, positions are shuffled by a permutation keyed on
+    (seed, epoch) and the epochs from initial_epoch are chained, so any
+    epoch can be replayed exactly and batches never cross epochs.
+    The batches are augmented per epoch when augmentation is given"""
+    if seed is None:
+        dataset = make_batches(tf.data.Dataset.range(size))
+        if augmentation is not None:
+            dataset = augment_dataset(dataset, augmentation)
+        return dataset
+
+    def permutation(epoch):
+        return np.random.default_rng([seed, int(epoch)]).permutation(size)
+
+    def batches(epoch):
+        positions = tf.numpy_function(permutation, [epoch], tf.int64)
+        positions.set_shape((size,))
+        dataset = make_batches(tf.data.Dataset.from_tensor_slices(positions))
+        if augmentation is not None:
+            dataset = augment_dataset(dataset, augmentation, seed, epoch)
+        return dataset
+
+    return tf.data.Dataset.range(initial_epoch, epochs).flat_map(batches)
+
+
+def make_path_dataset(paths: list,
+                      labels: np.ndarray,
+                      batch_size: int,
+                      seed: int = None,
+                      initial_epoch: int = 0,
+                      epochs: int = 1,
+                      augmentation: tuple = None) -> tf.data.Dataset:
+    """Create a dataset decoding the images lazily and in parallel.
+    Only the paths are kept in memory, images live for one batch"""
+    paths = tf.constant(paths, dtype=tf.string)
+    labels = tf.constant(labels, dtype=tf.int32)
+
+    def make_batches(positions):
+        dataset = positions.map(
+            lambda i: decode_image(paths[i], labels[i]),
+            num_parallel_calls=tf.data.AUTOTUNE)
+        return dataset.batch(batch_size)
+
+    dataset = epoch_dataset(len(labels), make_batches, seed,
+                            initial_epoch, epochs, augmentation)
+    return finish_dataset(dataset)
+
+
+def make_index_dataset(images: np.ndarray,
+                       labels: np.ndarray,
+                       indices: np.ndarray,
+                       batch_size: int,
+                       seed: int = None,
+                       initial_epoch: int = 0,
+                       epochs: int = 1,
+                       augmentation: tuple = None) -> tf.data.Dataset:
+    """Create a dataset gathering its batches by index from a backing
+    array (which can be a memmap), so pixel data is never duplicated"""
+    def gather(positions):
+        batch_indices = np.sort(indices[positions])
+        return (np.asarray(images[batch_indices], dtype=np.uint8),
+                labels[batch_indices].astype(np.int32))
+
+    def make_batches(positions):
+        return positions.batch(batch_size).map(
+            lambda pos: tf.numpy_function(gather, [pos],
+                                          (tf.uint8, tf.int32)),
+            num_parallel_calls=tf.data.AUTOTUNE).map(set_shape)
+
+    dataset = epoch_dataset(len(indices), make_batches, seed,
+                            initial_epoch, epochs, augmentation)
+    return finish_dataset(dataset)
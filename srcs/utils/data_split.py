@@ -0,0 +1,97 @@
+import os
+import json
+import numpy as np
+
+
+SUBSETS = ('train', 'valid', 'test')
+
+
+def stratified_split(labels: np.ndarray,
+                     train_ratio: float,
+                     test_ratio: float,
+                     seed: int) -> dict:
+    """Split the rows of every class on its own size into train,
+    validation and test index arrays. Pixel data is never touched,
+    the indices point into the backing array of the dataset"""
+    rng = np.random.default_rng(seed)
+    split = {subset: [] for subset in SUBSETS}
+    for label in np.unique(labels):
+        rows = rng.permutation(np.flatnonzero(labels == label))
+        trn_size = int(train_ratio * len(rows))
+        test_size = int(test_ratio * len(rows))
+        split['train'].append(rows[:trn_size])
+        split['test'].append(rows[trn_size:trn_size + test_size])
+        split['valid'].append(rows[trn_size + test_size:])
+    return {subset: np.sort(np.concatenate(rows)).astype(np.int64)
+            if len(rows) else np.empty(0, dtype=np.int64)
+            for subset, rows in split.items()}
+
+
+def save_split(path: str,
+               split: dict,
+               source: str,
+               files: list,
+               label_names: list,
+               seed: int) -> None:
+    """Save the split with the files it indexes, relative to source"""
+    data = {'source': os.path.abspath(source),
+            'seed': seed,
+            'labels': label_names,
+            'files': [os.path.relpath(file, source) for file in files]}
+    for subset in SUBSETS:
+        data[subset] = split[subset].tolist()
+    with open(path, 'w') as f:
+        json.dump(data, f)
+
+
+def read_split(path: str) -> dict:
+    """Read a split file"""
+    with open(path) as f:
+        data = json.load(f)
+    for subset in SUBSETS:
+        data[subset] = np.array(data[subset], dtype=np.int64)
+    return data
+
+
+def load_split(path: str, source: str, files: list) -> dict:
+    """Read a split file and map its indices on the current files.
+    Files removed since the split was made are dropped, new files are
+    not assigned to any subset"""
+    data = read_split(path)
+    current = {os.path.relpath(file, source): row
+               for row, file in enumerate(files)}
+    rows = np.array([current.get(file, -1) for file in data['files']],
+                    dtype=np.int64)
+
+    split = {}
+    for subset in SUBSETS:
+        mapped = rows[data[subset]]
+        split[subset] = np.sort(mapped[mapped >= 0])
+    assigned = sum(len(split[subset]) for subset in SUBSETS)
+    if assigned != len(files) or assigned != len(data['files']):
+        print(f"Split {path}: {len(files) - assigned} files not assigned, \
+{len(data['files']) - assigned} files missing")
+    return split
+
+
+def split_files(path: str, subset: str = 'test') -> list:
+    """Get the paths of the files of one subset of a split file"""
+    if subset not in SUBSETS:
+        raise ValueError(f"Subset are {', '.join(SUBSETS)} not {subset}")
+    data = read_split(path)
+    return [os.path.join(data['source'], data['files'][row])
+            for row in data[subset]]
+
+
+def oversample(indices: np.ndarray,
+               labels: np.ndarray,
+               seed: int) -> np.ndarray:
+    """Repeat randomly chosen indices of the smaller classes until every
+    class has as many indices as the biggest one"""
+    rng = np.random.default_rng(seed)
+    classes, counts = np.unique(labels[indices], return_counts=True)
+    extra = []
+    for label, count in zip(classes, counts):
+        rows = indices[labels[indices] == label]
+        extra.append(rng.choice(rows, counts.max() - count))
+    return np.sort(np.concatenate([indices, *extra]))
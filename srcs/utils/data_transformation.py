@@ -1,6 +1,76 @@
+import cv2
 import rembg
+import threading
+import numpy as np
 
+from PIL import Image
 from plantcv import plantcv as pcv
+from rembg.bg import naive_cutout
+
+from utils.color_histogram import color_histograms, histogram_series
+
+
+REMBG_MODELS = ('u2net', 'u2netp', 'u2net_human_seg', 'silueta',
+                'isnet-general-use')
+
+# Models whose session predicts like rembg's U2netSession, with the
+# normalization below, so their images can be scored as one batch. The
+# other models go through session.predict one image at a time
+REMBG_BATCH_MODELS = ('u2net', 'u2netp', 'u2net_human_seg', 'silueta')
+U2NET_NORMALIZATION = ((0.485, 0.456, 0.406), (0.229, 0.224, 0.225),
+                       (320, 320))
+
+BACKGROUND_MODES = ('quality', 'fast')
+
+# Distance to grey in the a/b plane above which a pixel is taken as leaf
+# by the fast background mask
+FAST_CHROMA_MIN = 12
+
+
+def check_rembg_model(args_handler, u_ipt):
+    """Check the rembg model asked by the user"""
+    if u_ipt['rembg-model'] not in REMBG_MODELS:
+        raise ValueError(f"Rembg models are {', '.join(REMBG_MODELS)} \
+not {u_ipt['rembg-model']}")
+    return u_ipt
+
+
+def check_background_mode(args_handler, u_ipt):
+    """Check the background mode asked by the user"""
+    if u_ipt['background-mode'] not in BACKGROUND_MODES:
+        raise ValueError(f"Background modes are \
+{', '.join(BACKGROUND_MODES)} not {u_ipt['background-mode']}")
+    return u_ipt
+
+
+def check_scale(args_handler, u_ipt):
+    """Check the scale of the masks asked by the user"""
+    if not 0 < u_ipt['scale'] <= 1:
+        raise ValueError(f"Scale must be in ]0, 1] not {u_ipt['scale']}")
+    return u_ipt
+
+
+_rembg_sessions = {}
+_rembg_lock = threading.Lock()
+
+
+def get_rembg_session(model_name='u2net'):
+    """
+    Return the rembg session of a model, created on first use and shared
+    by the whole process, so the onnx model is only loaded once
+
+    :param model_name: The name of the rembg model
+    :type model_name: str
+    :return: The rembg session
+    :rtype: rembg.sessions.BaseSession
+    """
+
+    if model_name not in REMBG_MODELS:
+        raise ValueError(f"Rembg model {model_name} is not supported")
+    with _rembg_lock:
+        if model_name not in _rembg_sessions:
+            _rembg_sessions[model_name] = rembg.new_session(model_name)
+        return _rembg_sessions[model_name]
 
 
 def imgt_gaussian_blur(mask, ksize=(3, 3)):
@@ -48,20 +118,123 @@ def imgt_mask_disease(img, background_mask):
     return img_mask
 
 
-def imgt_mask_background(img):
+def scaled_fill_size(scale):
+    """
+    return the size under which objects are filled, for an image resized
+    by scale: the 500 pixels of full size images scale with the area
+
+    :param scale: The scale of the image
+    :type scale: float
+    """
+
+    return max(1, round(500 * scale * scale))
+
+
+def imgt_downscale(img, scale):
+    """
+    return the image resized by scale, averaging the pixels
+
+    :param img: The image to resize
+    :type img: np.ndarray
+    :param scale: The scale, at most 1
+    :type scale: float
+    """
+
+    if scale >= 1:
+        return img
+    return cv2.resize(img, None, fx=scale, fy=scale,
+                      interpolation=cv2.INTER_AREA)
+
+
+def imgt_upscale_mask(mask, shape, refine=False):
+    """
+    return the mask resized to the height and width of shape. The nearest
+    pixel is taken, or the edges are smoothed by a bilinear interpolation
+    thresholded at half when refine is set
+
+    :param mask: The 0/255 mask to resize
+    :type mask: np.ndarray
+    :param shape: The shape of the full size image
+    :type shape: Tuple[int, int]
+    :param refine: Smooth the edges
+    :type refine: bool
+    """
+
+    size = (shape[1], shape[0])
+    if mask.shape[:2] == tuple(shape[:2]):
+        return mask
+    if not refine:
+        return cv2.resize(mask, size, interpolation=cv2.INTER_NEAREST)
+    mask = cv2.resize(mask, size, interpolation=cv2.INTER_LINEAR)
+    return np.where(mask >= 128, 255, 0).astype(np.uint8)
+
+
+def imgt_lab(img):
+    """
+    Split the image in its l, a and b channels, the same way
+    pcv.rgb2gray_lab does. Float images (as mplimg.imread gives for
+    pngs) are converted to uint8 first, so the channels are always 8-bit
+    with a and b centered on 128
+
+    :param img: The image to convert
+    :type img: np.ndarray
+    :return: The l, a and b channels
+    :rtype: Tuple[np.ndarray, np.ndarray, np.ndarray]
+    """
+
+    if img.dtype != np.uint8:
+        scale = 255 if img.max(initial=0) <= 1 else 1
+        img = np.clip(np.round(img * scale), 0, 255).astype(np.uint8)
+    return tuple(cv2.split(cv2.cvtColor(img, cv2.COLOR_BGR2LAB)))
+
+
+def imgt_shadow_mask(lightness, scale=1.0):
+    """
+    return the mask of the pixels lighter than the shadows
+
+    :param lightness: The l channel of the image
+    :type lightness: np.ndarray
+    :param scale: The scale of the image, scaling the fill and erosion
+    :type scale: float
+    """
+
+    shadow_mask = pcv.threshold.binary(lightness, 1, 'light')
+    shadow_mask = pcv.fill(bin_img=shadow_mask, size=scaled_fill_size(scale))
+    shadow_mask = pcv.erode(shadow_mask, max(2, round(5 * scale)), 1)
+
+    return shadow_mask
+
+
+def imgt_mask_background(img, model_name='u2net', shadow_mask=None):
     """
     return pixels of the image that are not in the mask
 
     :param img: The image to apply the mask to
     :type img: np.ndarray
+    :param model_name: The name of the rembg model
+    :type model_name: str
+    :param shadow_mask: The mask of imgt_shadow_mask, computed if None
+    :type shadow_mask: np.ndarray
     """
 
-    shadow_mask = pcv.rgb2gray_lab(img, channel='l')
-    shadow_mask = pcv.threshold.binary(shadow_mask, 1, 'light')
-    shadow_mask = pcv.fill(bin_img=shadow_mask, size=500)
-    shadow_mask = pcv.erode(shadow_mask, 5, 1)
+    if shadow_mask is None:
+        shadow_mask = imgt_shadow_mask(imgt_lab(img)[0])
+
+    img_withoutbg = rembg.remove(img, session=get_rembg_session(model_name))
+
+    return imgt_cutout_mask(img_withoutbg, shadow_mask)
+
+
+def imgt_cutout_mask(img_withoutbg, shadow_mask):
+    """
+    return the leaf mask from the cutout of rembg
+
+    :param img_withoutbg: The image with its background removed by rembg
+    :type img_withoutbg: np.ndarray
+    :param shadow_mask: The mask of imgt_shadow_mask
+    :type shadow_mask: np.ndarray
+    """
 
-    img_withoutbg = rembg.remove(img)
     grey_scale = pcv.rgb2gray_lab(img_withoutbg, channel='l')
     mask_withoutbg = pcv.threshold.binary(grey_scale, 20, 'light')
     mask_withoutbg = pcv.logical_and(shadow_mask, mask_withoutbg)
@@ -70,18 +243,103 @@ def imgt_mask_background(img):
     return mask_withoutbg
 
 
-def imgt_clear_background(img, mask):
+def rembg_predict_batch(images, model_name='u2net'):
+    """
+    return the rembg masks of several images, scored in one run of the
+    onnx session for the models of REMBG_BATCH_MODELS accepting a batch,
+    one image at a time otherwise. The masks are those rembg.remove
+    computes: the batch path follows U2netSession.predict of the rembg
+    version pinned in requirement.txt, and Benchmark.py -b batch-iou
+    checks it against rembg.remove for every model
+
+    :param images: The images to segment
+    :type images: List[np.ndarray]
+    :param model_name: The name of the rembg model
+    :type model_name: str
+    :return: The masks, at the size of their image
+    :rtype: List[PIL.Image.Image]
     """
-    return pixels of the image that are not in the mask
+
+    session = get_rembg_session(model_name)
+    pil_images = [Image.fromarray(img) for img in images]
+    if model_name not in REMBG_BATCH_MODELS:
+        return [session.predict(img)[0] for img in pil_images]
+
+    inputs = [session.normalize(img, *U2NET_NORMALIZATION)
+              for img in pil_images]
+    name = session.inner_session.get_inputs()[0].name
+    batch_dim = session.inner_session.get_inputs()[0].shape[0]
+
+    if len(inputs) > 1 and not isinstance(batch_dim, int):
+        batch = np.concatenate([inpt[name] for inpt in inputs])
+        preds = session.inner_session.run(None, {name: batch})[0][:, 0]
+    else:
+        preds = np.concatenate([session.inner_session.run(None, inpt)[0][:, 0]
+                                for inpt in inputs])
+
+    masks = []
+    for img, pred in zip(pil_images, preds):
+        pred = (pred - np.min(pred)) / (np.max(pred) - np.min(pred))
+        mask = Image.fromarray((pred * 255).astype('uint8'), mode='L')
+        masks.append(mask.resize(img.size, Image.LANCZOS))
+    return masks
+
+
+def imgt_mask_background_batch(images, model_name='u2net', shadow_masks=None):
+    """
+    return the masks of imgt_mask_background for several images, running
+    rembg on them as one batch
+
+    :param images: The images to apply the mask to
+    :type images: List[np.ndarray]
+    :param model_name: The name of the rembg model
+    :type model_name: str
+    :param shadow_masks: The masks of imgt_shadow_mask, computed if None
+    :type shadow_masks: List[np.ndarray]
+    """
+
+    if shadow_masks is None:
+        shadow_masks = [imgt_shadow_mask(imgt_lab(img)[0]) for img in images]
+
+    masks = rembg_predict_batch(images, model_name)
+    return [imgt_cutout_mask(np.asarray(naive_cutout(Image.fromarray(img),
+                                                     mask)), shadow_mask)
+            for img, mask, shadow_mask in zip(images, masks, shadow_masks)]
+
+
+def imgt_mask_background_fast(img, shadow_mask=None, lab=None, scale=1.0):
+    """
+    return the leaf mask of an image on a uniform background without
+    rembg: the pixels colored enough in the lab space and out of the
+    shadows
 
     :param img: The image to apply the mask to
     :type img: np.ndarray
+    :param shadow_mask: The mask of imgt_shadow_mask, computed if None
+    :type shadow_mask: np.ndarray
+    :param lab: The channels of imgt_lab, computed if None
+    :type lab: Tuple[np.ndarray, np.ndarray, np.ndarray]
+    :param scale: The scale of the image, scaling the fill
+    :type scale: float
     """
 
-    return pcv.apply_mask(img, mask, "white")
+    if lab is None:
+        lab = imgt_lab(img)
+    if shadow_mask is None:
+        shadow_mask = imgt_shadow_mask(lab[0], scale)
+
+    a = lab[1].astype(np.int32) - 128
+    b = lab[2].astype(np.int32) - 128
+    chroma = a * a + b * b > FAST_CHROMA_MIN * FAST_CHROMA_MIN
+    mask = np.where(chroma, 255, 0).astype(np.uint8)
+    mask = pcv.logical_and(shadow_mask, mask)
+    mask = pcv.fill(bin_img=mask, size=scaled_fill_size(scale))
+    mask = pcv.fill_holes(bin_img=mask)
+
+    return mask
 
 
-def imgt_roi(img, mask):
+def imgt_clear_background(img, mask):
     """
     return pixels of the image that are not in the mask
 
@@ -89,6 +347,17 @@ def imgt_roi(img, mask):
     :type img: np.ndarray
     """
 
+    return pcv.apply_mask(img, mask, "white")
+
+
+def imgt_roi_mask(mask):
+    """
+    return the objects of the mask inside the rectangle of the whole image
+
+    :param mask: The mask to filter
+    :type mask: np.ndarray
+    """
+
     roi = pcv.roi.rectangle(
         img=mask,
         x=0,
@@ -96,7 +365,21 @@ def imgt_roi(img, mask):
         w=mask.shape[0],
         h=mask.shape[1]
     )
-    roi_mask = pcv.roi.filter(mask=mask, roi=roi, roi_type='partial')
+    return pcv.roi.filter(mask=mask, roi=roi, roi_type='partial')
+
+
+def imgt_roi(img, mask, roi_mask=None):
+    """
+    return pixels of the image that are not in the mask
+
+    :param img: The image to apply the mask to
+    :type img: np.ndarray
+    :param roi_mask: The mask of imgt_roi_mask, computed if None
+    :type roi_mask: np.ndarray
+    """
+
+    if roi_mask is None:
+        roi_mask = imgt_roi_mask(mask)
     border_size = 5
 
     img_roi = img.copy()
@@ -109,64 +392,52 @@ def imgt_roi(img, mask):
     return img_roi
 
 
-def imgt_analyse(img, mask):
+def imgt_analyse(img, mask, roi_mask=None):
     """
     return pixels of the image that are not in the mask
 
     :param img: The image to apply the mask to
     :type img: np.ndarray
+    :param roi_mask: The mask of imgt_roi_mask, computed if None
+    :type roi_mask: np.ndarray
     """
 
-    roi = pcv.roi.rectangle(
-        img=mask,
-        x=0,
-        y=0,
-        w=mask.shape[0],
-        h=mask.shape[1]
-    )
-    roi_mask = pcv.roi.filter(mask=mask, roi=roi, roi_type='partial')
+    if roi_mask is None:
+        roi_mask = imgt_roi_mask(mask)
     analysis_img = pcv.analyze.size(img, roi_mask)
 
     return analysis_img
 
 
-def imgt_x_pseudolandmarks(img, mask):
+def imgt_x_pseudolandmarks(img, mask, roi_mask=None):
     """
     return pixels of the image that are not in the mask
 
     :param img: The image to apply the mask to
     :type img: np.ndarray
+    :param roi_mask: The mask of imgt_roi_mask, computed if None
+    :type roi_mask: np.ndarray
     """
 
-    roi = pcv.roi.rectangle(
-        img=mask,
-        x=0,
-        y=0,
-        w=mask.shape[0],
-        h=mask.shape[1]
-    )
-    roi_mask = pcv.roi.filter(mask=mask, roi=roi, roi_type='partial')
+    if roi_mask is None:
+        roi_mask = imgt_roi_mask(mask)
     top, bottom, center_v = pcv.homology.x_axis_pseudolandmarks(img, roi_mask)
 
     return top, bottom, center_v
 
 
-def imgt_y_pseudolandmarks(img, mask):
+def imgt_y_pseudolandmarks(img, mask, roi_mask=None):
     """
     return pixels of the image that are not in the mask
 
     :param img: The image to apply the mask to
     :type img: np.ndarray
+    :param roi_mask: The mask of imgt_roi_mask, computed if None
+    :type roi_mask: np.ndarray
     """
 
-    roi = pcv.roi.rectangle(
-        img=mask,
-        x=0,
-        y=0,
-        w=mask.shape[0],
-        h=mask.shape[1]
-    )
-    roi_mask = pcv.roi.filter(mask=mask, roi=roi, roi_type='partial')
+    if roi_mask is None:
+        roi_mask = imgt_roi_mask(mask)
     left, right, center_h = pcv.homology.y_axis_pseudolandmarks(img, roi_mask)
 
     return left, right, center_h
@@ -204,12 +475,14 @@ def from_360_to_255(x, y):
     return x[:127], y[:127]
 
 
-def imgt_color_histogram(img, mask):
+def imgt_color_histogram(img, mask, roi_mask=None):
     """
     return pixels of the image that are not in the mask
 
     :param img: The image to apply the mask to
     :type img: np.ndarray
+    :param roi_mask: The mask of imgt_roi_mask, computed if None
+    :type roi_mask: np.ndarray
     """
 
     all_frequencies = {
@@ -227,19 +500,12 @@ def imgt_color_histogram(img, mask):
        'value_frequencies': [from_0_100_to_0_255, 'orange'],
     }
 
-    roi = pcv.roi.rectangle(
-        img=mask,
-        x=0,
-        y=0,
-        w=mask.shape[0],
-        h=mask.shape[1]
-    )
-    roi_mask = pcv.roi.filter(mask=mask, roi=roi, roi_type='partial')
-    pcv.analyze.color(img, roi_mask, colorspaces='all', label='default')
+    if roi_mask is None:
+        roi_mask = imgt_roi_mask(mask)
+    series = histogram_series(color_histograms(img, roi_mask))
     out = {}
     for key, value in all_frequencies.items():
-        x = pcv.outputs.observations['default_1'][key]['label']
-        y = pcv.outputs.observations['default_1'][key]['value']
+        x, y = series[key]
         if value[0] is not None:
             x, y = value[0](x, y)
         out[key] = (x, y, value[1])
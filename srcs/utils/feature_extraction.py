@@ -0,0 +1,141 @@
+import os
+import numpy as np
+import matplotlib.image as mplimg
+
+from plantcv import plantcv as pcv
+
+from utils.color_histogram import color_histograms, HISTOGRAMS, NB_BINS
+from utils.data_transformation import imgt_analyse, imgt_x_pseudolandmarks
+from utils.data_transformation import imgt_y_pseudolandmarks
+from utils.transformation_context import TransformationContext
+
+
+NB_LANDMARKS = 20
+FEATURE_FORMATS = ('npz', 'parquet')
+
+
+def landmarks_array(points) -> np.ndarray:
+    """Return the pseudolandmarks as NB_LANDMARKS (x, y) rows, padded
+    with nan when plantcv found less of them"""
+    points = np.asarray(points, dtype=np.float32).reshape(-1, 2)
+    out = np.full((NB_LANDMARKS, 2), np.nan, dtype=np.float32)
+    out[:min(len(points), NB_LANDMARKS)] = points[:NB_LANDMARKS]
+    return out
+
+
+def init_worker() -> None:
+    """Start every worker with a clean plantcv state"""
+    pcv.params.debug = None
+    pcv.outputs.clear()
+
+
+def extract_features(path: str, model_name: str = 'u2net') -> dict:
+    """Compute the features of one image: the area of its disease mask,
+    its x and y pseudolandmarks and its color histograms"""
+    img = mplimg.imread(path)
+    context = TransformationContext(img, model_name)
+    try:
+        imgt_analyse(img, context.disease_mask, context.roi_mask)
+        area = pcv.outputs.observations['default_1']['area']['value']
+        x_landmarks = imgt_x_pseudolandmarks(img, context.disease_mask,
+                                             context.roi_mask)
+        y_landmarks = imgt_y_pseudolandmarks(img, context.disease_mask,
+                                             context.roi_mask)
+    finally:
+        pcv.outputs.clear()
+    return {
+        'area': float(area),
+        'x_landmarks': np.stack([landmarks_array(p) for p in x_landmarks]),
+        'y_landmarks': np.stack([landmarks_array(p) for p in y_landmarks]),
+        'histograms': color_histograms(img, context.roi_mask)
+        .astype(np.float32),
+    }
+
+
+def extract_task(task: tuple) -> tuple:
+    """Pool task: return the index of the image with its features, or
+    with the error met"""
+    index, path, model_name = task
+    try:
+        return index, extract_features(path, model_name), None
+    except Exception as e:
+        return index, None, str(e)
+
+
+class FeatureWriter:
+    """Write feature rows in shards of shard_size rows, so only one
+    shard is held in memory. Shards are npz files, or parquet files
+    when pyarrow is installed and asked for"""
+    def __init__(self, output_dir: str, shard_size: int = 1000,
+                 file_format: str = 'npz'):
+        if file_format not in FEATURE_FORMATS:
+            raise ValueError(f"Feature formats are \
+{', '.join(FEATURE_FORMATS)} not {file_format}")
+        if file_format == 'parquet':
+            try:
+                import pyarrow  # noqa: F401
+            except ImportError:
+                raise ValueError("Writing parquet needs pyarrow installed")
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+        self.shard_size = shard_size
+        self.file_format = file_format
+        self.rows = []
+        self.shards = []
+
+    def add(self, path: str, label: str, features: dict) -> None:
+        self.rows.append((path, label, features))
+        if len(self.rows) >= self.shard_size:
+            self.flush()
+
+    def columns(self) -> dict:
+        """The rows of the shard as one array per feature"""
+        paths, labels, features = zip(*self.rows)
+        return {
+            'path': np.array(paths),
+            'label': np.array(labels),
+            **{key: np.stack([f[key] for f in features])
+               for key in features[0]},
+        }
+
+    def flush(self) -> None:
+        if not self.rows:
+            return
+        name = f"features_{len(self.shards):05d}.{self.file_format}"
+        shard_path = os.path.join(self.output_dir, name)
+        columns = self.columns()
+        if self.file_format == 'npz':
+            np.savez(shard_path, **columns)
+        else:
+            write_parquet(shard_path, columns)
+        self.shards.append(shard_path)
+        self.rows = []
+
+
+def write_parquet(path: str, columns: dict) -> None:
+    """Write the columns in a parquet file, the arrays of a row being
+    flattened in one list column named after its shape"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table = {}
+    for key, values in columns.items():
+        if values.ndim == 1:
+            table[key] = pa.array(values.tolist())
+        else:
+            flat = values.reshape(len(values), -1)
+            table[key] = pa.array(list(flat))
+    schema_metadata = {key: str(values.shape[1:])
+                       for key, values in columns.items() if values.ndim > 1}
+    pq.write_table(pa.table(table, metadata=schema_metadata), path)
+
+
+def feature_names() -> dict:
+    """Describe the axes of the feature arrays"""
+    return {
+        'area': 'pixels of the disease mask',
+        'x_landmarks': f"(top, bottom, center_v) x {NB_LANDMARKS} x (x, y)",
+        'y_landmarks': f"(left, right, center_h) x {NB_LANDMARKS} x (x, y)",
+        'histograms': f"({', '.join(key for key, _ in HISTOGRAMS)}) x \
+{NB_BINS} bins",
+    }
@@ -0,0 +1,10 @@
+import hashlib
+
+
+def file_digest(path: str) -> str:
+    """Hash the content of a file"""
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
@@ -0,0 +1,169 @@
+import os
+import queue
+import collections
+import threading
+import multiprocessing
+import multiprocessing.pool
+import numpy as np
+from PIL import Image
+
+
+IMG_SIZE = (256, 256)
+
+
+def list_image_paths(path: str, depth: int) -> list:
+    """Get the image paths of every class folder at depth from path"""
+    if depth == 0:
+        with os.scandir(path) as it:
+            all_path = sorted(entry.path for entry in it if entry.is_file())
+        return [(os.path.basename(path), all_path)]
+    all_class = []
+    with os.scandir(path) as it:
+        for entry in sorted(it, key=lambda e: e.name):
+            if entry.is_dir():
+                all_class += list_image_paths(entry.path, depth - 1)
+    return all_class
+
+
+def list_image_files(path: str) -> list:
+    """Get the paths of all the files in path, recursively"""
+    all_path = []
+    with os.scandir(path) as it:
+        for entry in sorted(it, key=lambda e: e.name):
+            if entry.is_file():
+                all_path.append(entry.path)
+            elif entry.is_dir():
+                all_path += list_image_files(entry.path)
+    return all_path
+
+
+def read_image(path: str) -> np.ndarray:
+    """Decode an image file into a 256x256x3 uint8 array"""
+    with Image.open(path) as img:
+        img = img.convert('RGB')
+        if img.size != IMG_SIZE:
+            img = img.resize(IMG_SIZE)
+        return np.asarray(img, dtype=np.uint8)
+
+
+def load_images(paths: list,
+                workers: int = None,
+                out: np.ndarray = None,
+                rows: list = None) -> np.ndarray:
+    """Decode the images on a pool of workers processes.
+    The image of paths[i] is written in out[rows[i]], by default a new
+    contiguous (N, 256, 256, 3) uint8 array in the order of paths"""
+    if out is None:
+        out = np.empty((len(paths), *IMG_SIZE, 3), dtype=np.uint8)
+    if rows is None:
+        rows = range(len(paths))
+    if workers is None:
+        workers = os.cpu_count()
+    workers = max(1, min(workers, len(paths)))
+
+    if workers == 1:
+        for row, path in zip(rows, paths):
+            out[row] = read_image(path)
+        return out
+
+    chunksize = max(1, min(64, len(paths) // (workers * 4)))
+    # Forking a process running tensorflow threads can deadlock, the
+    # workers are started fresh
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(workers) as pool:
+        for row, img in zip(rows, pool.imap(read_image, paths, chunksize)):
+            out[row] = img
+    return out
+
+
+def list_image_labels(path: str, depth: int) -> tuple:
+    """List the images of the class folders at depth from path.
+    Return the class names, the paths and the labels array"""
+    all_class = list_image_paths(path, depth)
+    paths, labels = [], []
+    for label, (_, class_paths) in enumerate(all_class):
+        paths += class_paths
+        labels += [label] * len(class_paths)
+    return ([name for name, _ in all_class],
+            paths,
+            np.array(labels, dtype=np.int32))
+
+
+def load_image_tree(path: str, depth: int, workers: int = None) -> tuple:
+    """Decode every image of the class folders at depth from path.
+    Return the class names, the paths, the labels and the images arrays"""
+    names, paths, labels = list_image_labels(path, depth)
+    return names, paths, labels, load_images(paths, workers)
+
+
+def iter_image_batches(paths: list,
+                       batch_size: int,
+                       workers: int = None,
+                       prefetch: int = 2):
+    """Yield (paths, images) batches decoded in the background.
+    A thread feeds a pool of workers processes and keeps at most
+    prefetch decoded batches waiting, so memory does not depend on the
+    number of paths"""
+    batches = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def send(batch_paths, images):
+        if isinstance(images, multiprocessing.pool.AsyncResult):
+            images = images.get()
+        batch = np.empty((len(images), *IMG_SIZE, 3), dtype=np.uint8)
+        for j, img in enumerate(images):
+            batch[j] = img
+        return put((batch_paths, batch))
+
+    def decode(pool):
+        pending = collections.deque()
+        for i in range(0, len(paths), batch_size):
+            batch_paths = paths[i:i + batch_size]
+            if pool is None:
+                images = [read_image(path) for path in batch_paths]
+            else:
+                images = pool.map_async(read_image, batch_paths)
+            pending.append((batch_paths, images))
+            if len(pending) > prefetch and not send(*pending.popleft()):
+                return
+        while pending:
+            if not send(*pending.popleft()):
+                return
+
+    def producer():
+        try:
+            nb_workers = os.cpu_count() if workers is None else workers
+            if nb_workers <= 1:
+                decode(None)
+            else:
+                # Forking a process running tensorflow threads can
+                # deadlock, the workers are started fresh
+                context = multiprocessing.get_context('spawn')
+                with context.Pool(nb_workers) as pool:
+                    decode(pool)
+            put(None)
+        except Exception as e:
+            put(e)
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = batches.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
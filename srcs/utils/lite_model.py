@@ -0,0 +1,53 @@
+import numpy as np
+
+try:
+    from tflite_runtime.interpreter import Interpreter
+except ImportError:
+    import tensorflow as tf
+    Interpreter = tf.lite.Interpreter
+
+
+class LiteModel:
+    """Run a TFLite model with the lightweight tflite_runtime interpreter
+    when it is installed, the one of tensorflow otherwise.
+    Inputs and outputs are (de)quantized for integer models"""
+    def __init__(self, path: str, threads: int = None):
+        self.interpreter = Interpreter(model_path=path, num_threads=threads)
+        self.interpreter.allocate_tensors()
+        self.input = self.interpreter.get_input_details()[0]
+        self.output = self.interpreter.get_output_details()[0]
+        self.batch_size = self.input['shape'][0]
+
+    def resize(self, batch_size: int) -> None:
+        """Resize the input tensor to batch_size images"""
+        if batch_size == self.batch_size:
+            return
+        shape = [batch_size, *self.input['shape'][1:]]
+        self.interpreter.resize_tensor_input(self.input['index'], shape)
+        self.interpreter.allocate_tensors()
+        self.input = self.interpreter.get_input_details()[0]
+        self.output = self.interpreter.get_output_details()[0]
+        self.batch_size = batch_size
+
+    def predict(self, images: np.ndarray) -> np.ndarray:
+        """Return the float scores of a (N, 256, 256, 3) batch"""
+        self.resize(len(images))
+        dtype = self.input['dtype']
+        scale, zero_point = self.input['quantization']
+        if np.issubdtype(dtype, np.integer):
+            if scale:
+                images = np.round(images / scale + zero_point)
+            info = np.iinfo(dtype)
+            images = np.clip(images, info.min, info.max)
+        self.interpreter.set_tensor(self.input['index'],
+                                    np.asarray(images, dtype=dtype))
+        self.interpreter.invoke()
+
+        scores = self.interpreter.get_tensor(self.output['index'])
+        scale, zero_point = self.output['quantization']
+        if np.issubdtype(scores.dtype, np.integer) and scale:
+            scores = (scores.astype(np.float32) - zero_point) * scale
+        return scores.astype(np.float32)
+
+    def __call__(self, images: np.ndarray) -> np.ndarray:
+        return self.predict(images)
@@ -0,0 +1,114 @@
+import os
+import json
+
+from utils.hashing import file_digest
+
+
+MANIFEST_FILE = '.manifest.json'
+
+
+class Manifest:
+    """Record, in the destination folder of a tool, the source files it
+    processed with their size, mtime and content hash, the outputs it
+    wrote for them and the parameters of the run.
+
+    A source is up to date when it was processed with the same
+    parameters, its outputs still exist and its size and mtime did not
+    change (or its content hash did not, when only its mtime changed).
+
+    When the parameters changed, the entries of the previous run are
+    dropped and their outputs are kept in stale, until remove_stale
+    deletes those the new run did not write again.
+    """
+    def __init__(self, destination: str, params: dict):
+        self.path = os.path.join(destination, MANIFEST_FILE)
+        self.destination = destination
+        self.params = params
+        self.entries = {}
+        data = self.load()
+        self.stale = set(data.get('stale', []))
+        if data.get('params') == params:
+            self.entries = data.get('entries', {})
+        else:
+            for entry in data.get('entries', {}).values():
+                self.stale.update(entry['outputs'])
+
+    def load(self) -> dict:
+        """Read the manifest file, empty when missing or unreadable"""
+        if not os.path.isfile(self.path):
+            return {}
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (ValueError, OSError) as e:
+            print(f"Manifest {self.path} ignored: {e}")
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    def remove_outputs(self, outputs) -> int:
+        """Delete the outputs, relative to the destination, still on disk.
+        Return the number of outputs deleted"""
+        removed = 0
+        for output in outputs:
+            output = os.path.join(self.destination, output)
+            if os.path.isfile(output):
+                os.remove(output)
+                removed += 1
+        return removed
+
+    def is_current(self, relpath: str, path: str) -> bool:
+        """Tell if the source at path was processed and did not change"""
+        entry = self.entries.get(relpath)
+        if entry is None:
+            return False
+        if not all(os.path.isfile(os.path.join(self.destination, output))
+                   for output in entry['outputs']):
+            return False
+        stat = os.stat(path)
+        if stat.st_size != entry['size']:
+            return False
+        if stat.st_mtime_ns != entry['mtime']:
+            if entry['digest'] is None \
+                    or file_digest(path) != entry['digest']:
+                return False
+            entry['mtime'] = stat.st_mtime_ns
+        return True
+
+    def record(self, relpath: str, path: str, outputs: list,
+               digest: str = None) -> None:
+        """Record the outputs written for the source at path. digest is
+        the content hash of the source, computed by the worker that read
+        it. Without it, the source is processed again if only its mtime
+        changes"""
+        stat = os.stat(path)
+        self.entries[relpath] = {
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns,
+            'digest': digest,
+            'outputs': [os.path.relpath(output, self.destination)
+                        for output in outputs],
+        }
+
+    def remove_deleted(self, relpaths: set) -> int:
+        """Delete the outputs of the sources not in relpaths anymore.
+        Return the number of sources removed"""
+        deleted = [relpath for relpath in self.entries
+                   if relpath not in relpaths]
+        for relpath in deleted:
+            self.remove_outputs(self.entries.pop(relpath)['outputs'])
+        return len(deleted)
+
+    def remove_stale(self) -> int:
+        """Delete the outputs of a run with other parameters, except those
+        written again by this run. Return the number of outputs deleted"""
+        written = {output for entry in self.entries.values()
+                   for output in entry['outputs']}
+        removed = self.remove_outputs(self.stale - written)
+        self.stale = set()
+        return removed
+
+    def save(self) -> None:
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump({'params': self.params, 'entries': self.entries,
+                       'stale': sorted(self.stale)}, f)
+        os.replace(self.path + '.tmp', self.path)
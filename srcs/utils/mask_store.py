@@ -0,0 +1,129 @@
+import time
+import sqlite3
+import numpy as np
+
+
+# Bump when the mask computation changes, so the stored masks are stale
+MASK_VERSION = 1
+
+# The size of the store is read again every EVICT_EVERY puts, to count
+# the masks other processes put. Eviction goes down to EVICT_TO of the
+# bound, so it does not run again on the next put
+EVICT_EVERY = 256
+EVICT_TO = 0.9
+
+
+def mask_model(model_name: str, mode: str = 'quality',
+               scale: float = 1.0) -> str:
+    """Version of the segmentation giving a background mask, computed on
+    the image resized by scale"""
+    model = f"v{MASK_VERSION}:fast" if mode == 'fast' \
+        else f"v{MASK_VERSION}:{mode}:{model_name}"
+    if scale < 1:
+        model += f":x{scale:g}"
+    return model
+
+
+class MaskStore:
+    """On-disk store of the background masks, keyed by the content hash
+    of the image file and the version of the segmentation model.
+
+    Masks are stored bit-packed. When the packed masks exceed max_bytes,
+    the least recently used ones are evicted. The size is tracked from
+    the puts instead of summed on each of them.
+    """
+    def __init__(self, path: str, max_bytes: int = 1 << 30):
+        self.max_bytes = max_bytes
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.execute('CREATE TABLE IF NOT EXISTS masks ('
+                        'digest TEXT, model TEXT, height INTEGER, '
+                        'width INTEGER, bits BLOB, last_used REAL, '
+                        'PRIMARY KEY (digest, model))')
+        self.db.execute('CREATE INDEX IF NOT EXISTS masks_last_used '
+                        'ON masks (last_used)')
+        self.db.commit()
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+        self.bytes = self.stored_bytes()
+
+    def stored_bytes(self) -> int:
+        """Total size of the packed masks"""
+        return self.db.execute('SELECT COALESCE(SUM(LENGTH(bits)), 0) '
+                               'FROM masks').fetchone()[0]
+
+    def get(self, digest: str, model: str) -> np.ndarray:
+        """Return the stored 0/255 uint8 mask, or None"""
+        row = self.db.execute('SELECT height, width, bits FROM masks '
+                              'WHERE digest = ? AND model = ?',
+                              (digest, model)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.db.execute('UPDATE masks SET last_used = ? '
+                        'WHERE digest = ? AND model = ?',
+                        (time.time(), digest, model))
+        self.db.commit()
+        self.hits += 1
+        height, width, bits = row
+        mask = np.unpackbits(np.frombuffer(bits, dtype=np.uint8),
+                             count=height * width)
+        return mask.reshape(height, width) * np.uint8(255)
+
+    def put(self, digest: str, model: str, mask: np.ndarray) -> None:
+        """Store a mask and evict the least recently used ones above the
+        size bound"""
+        bits = np.packbits(np.asarray(mask) > 0).tobytes()
+        self.db.execute('INSERT OR REPLACE INTO masks VALUES '
+                        '(?, ?, ?, ?, ?, ?)',
+                        (digest, model, mask.shape[0], mask.shape[1], bits,
+                         time.time()))
+        self.db.commit()
+        self.puts += 1
+        self.bytes += len(bits)
+        if self.puts % EVICT_EVERY == 0 or self.bytes > self.max_bytes:
+            # Replaced masks are counted twice by the estimate
+            self.bytes = self.stored_bytes()
+            if self.bytes > self.max_bytes:
+                self.evict(int(self.max_bytes * EVICT_TO))
+
+    def evict(self, max_bytes: int) -> int:
+        """Remove the least recently used masks until they fit in
+        max_bytes. Return the number of masks removed"""
+        removed = self.db.execute(
+            'DELETE FROM masks WHERE rowid IN (SELECT rowid FROM '
+            '(SELECT rowid, SUM(LENGTH(bits)) OVER (ORDER BY last_used '
+            'DESC) AS total FROM masks) WHERE total > ?)',
+            (max_bytes,)).rowcount
+        self.db.commit()
+        self.bytes = self.stored_bytes()
+        return removed
+
+    def prune(self, models: list = None, max_age: float = None) -> int:
+        """Remove the masks of the models not in models, and those not
+        used for max_age seconds. Return the number of masks removed"""
+        removed = 0
+        if models is not None:
+            removed += self.db.execute(
+                'DELETE FROM masks WHERE model NOT IN '
+                f"({','.join('?' * len(models))})", models).rowcount
+        if max_age is not None:
+            removed += self.db.execute('DELETE FROM masks WHERE last_used < ?',
+                                       (time.time() - max_age,)).rowcount
+        self.db.commit()
+        self.bytes = self.stored_bytes()
+        return removed
+
+    def stats(self) -> dict:
+        """Number of masks and bytes stored per model"""
+        return {model: {'masks': count, 'bytes': size}
+                for model, count, size in self.db.execute(
+                    'SELECT model, COUNT(*), SUM(LENGTH(bits)) FROM masks '
+                    'GROUP BY model')}
+
+    def vacuum(self) -> None:
+        """Give the space of the removed masks back to the filesystem"""
+        self.db.execute('VACUUM')
+
+    def close(self) -> None:
+        self.db.close()
@@ -0,0 +1,108 @@
+import time
+import queue
+import threading
+import collections
+import numpy as np
+from concurrent.futures import Future
+
+
+class MicroBatcher:
+    """Group the images submitted by concurrent requests into batches.
+
+    A worker thread waits for a first image, then gathers the following
+    ones for at most max_wait seconds or until max_batch_size images, and
+    scores the batch with predictor in a single call. Each submit returns
+    a Future resolved with the scores of its image. The requests still
+    queued when the batcher is closed fail with a RuntimeError.
+    """
+    def __init__(self, predictor, max_batch_size: int = 16,
+                 max_wait: float = 0.005):
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=1000)
+        self.batch_sizes = collections.deque(maxlen=1000)
+        self.counters = {'requests': 0, 'batches': 0, 'errors': 0}
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, image: np.ndarray) -> Future:
+        """Queue one (256, 256, 3) uint8 image"""
+        future = Future()
+        with self.lock:
+            if not self.running:
+                raise RuntimeError("The batcher is closed")
+            self.requests.put((image, future, time.perf_counter()))
+        return future
+
+    def predict(self, image: np.ndarray, timeout: float = None):
+        """Score one image, waiting for the batch it is part of"""
+        return self.submit(image).result(timeout)
+
+    def next_batch(self) -> list:
+        """Wait for a first request and gather the batch around it"""
+        batch = [self.requests.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                if remaining > 0:
+                    batch.append(self.requests.get(timeout=remaining))
+                else:
+                    batch.append(self.requests.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while self.running:
+            batch = [item for item in self.next_batch() if item is not None]
+            if not batch:
+                continue
+            images, futures, starts = zip(*batch)
+            try:
+                scores = self.predictor(np.stack(images))
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                with self.lock:
+                    self.counters['errors'] += len(batch)
+                continue
+            end = time.perf_counter()
+            for future, score in zip(futures, scores):
+                future.set_result(score)
+            with self.lock:
+                self.counters['requests'] += len(batch)
+                self.counters['batches'] += 1
+                self.batch_sizes.append(len(batch))
+                self.latencies.extend(end - start for start in starts)
+
+    def metrics(self) -> dict:
+        """Counters, queue depth and latency of the recent requests"""
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            sizes = np.array(self.batch_sizes)
+            metrics = dict(self.counters)
+        metrics['queue_depth'] = self.requests.qsize()
+        metrics['mean_batch_size'] = float(sizes.mean()) if len(sizes) else 0
+        for p in (50, 95, 99):
+            metrics[f"latency_p{p}_ms"] = float(np.percentile(latencies, p)) \
+                if len(latencies) else 0.0
+        return metrics
+
+    def close(self):
+        """Stop the worker thread and fail the requests it left queued"""
+        with self.lock:
+            self.running = False
+        self.requests.put(None)
+        self.thread.join()
+        while True:
+            try:
+                item = self.requests.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                item[1].set_exception(RuntimeError("The batcher is closed"))
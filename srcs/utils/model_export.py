@@ -0,0 +1,46 @@
+import os
+import tempfile
+import numpy as np
+import tensorflow as tf
+
+
+QUANTIZATIONS = ('int8', 'float16', 'dynamic')
+
+
+def export_tflite(model,
+                  path: str,
+                  quantization: str,
+                  calibration=None) -> int:
+    """Convert the keras model to a post-training quantized TFLite model.
+    int8 quantizes weights and activations with a uint8 input and output,
+    calibrated on calibration, an iterable of (256, 256, 3) uint8 images.
+    float16 stores float16 weights, dynamic quantizes the weights only.
+    Return the size of the written model"""
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f"Quantization are {', '.join(QUANTIZATIONS)} \
+not {quantization}")
+
+    with tempfile.TemporaryDirectory() as saved_model:
+        model.export(saved_model)
+        converter = tf.lite.TFLiteConverter.from_saved_model(saved_model)
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        if quantization == 'float16':
+            converter.target_spec.supported_types = [tf.float16]
+        elif quantization == 'int8':
+            if calibration is None:
+                raise ValueError("int8 quantization needs calibration data")
+
+            def representative_dataset():
+                for img in calibration:
+                    yield [np.expand_dims(img, axis=0).astype(np.float32)]
+
+            converter.representative_dataset = representative_dataset
+            converter.target_spec.supported_ops = [
+                tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+            converter.inference_input_type = tf.uint8
+            converter.inference_output_type = tf.uint8
+        tflite_model = converter.convert()
+
+    with open(path, 'wb') as f:
+        f.write(tflite_model)
+    return os.path.getsize(path)
@@ -0,0 +1,72 @@
+import time
+import sqlite3
+import hashlib
+import numpy as np
+
+from utils.hashing import file_digest
+
+
+def model_fingerprint(paths: list) -> str:
+    """Hash the content of the files defining the model, so the cache is
+    invalidated when the model or the labels change"""
+    sha = hashlib.sha256()
+    for path in paths:
+        sha.update(file_digest(path).encode())
+    return sha.hexdigest()
+
+
+class PredictionCache:
+    """On-disk cache of the scores of images, keyed by the content hash
+    of the image file. Entries of another model fingerprint are dropped
+    when the cache is opened. When more than max_entries scores are
+    stored, the least recently used ones are evicted"""
+    def __init__(self, path: str, fingerprint: str,
+                 max_entries: int = 1000000):
+        self.max_entries = max_entries
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS scores ('
+                        'digest TEXT PRIMARY KEY, model TEXT, '
+                        'scores BLOB, last_used REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS scores_last_used '
+                        'ON scores (last_used)')
+        self.db.execute('DELETE FROM scores WHERE model != ?', (fingerprint,))
+        self.db.commit()
+        self.fingerprint = fingerprint
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, digests: list) -> dict:
+        """Return the cached scores of the digests found, marking them as
+        used"""
+        found = {}
+        for i in range(0, len(digests), 500):
+            chunk = digests[i:i + 500]
+            rows = self.db.execute(
+                'SELECT digest, scores FROM scores WHERE digest IN '
+                f"({','.join('?' * len(chunk))})", chunk)
+            for digest, scores in rows:
+                found[digest] = np.frombuffer(scores, dtype=np.float32)
+        now = time.time()
+        self.db.executemany('UPDATE scores SET last_used = ? WHERE digest = ?',
+                            [(now, digest) for digest in found])
+        self.db.commit()
+        self.hits += len(found)
+        self.misses += len(set(digests)) - len(found)
+        return found
+
+    def put_many(self, digests: list, scores: np.ndarray) -> None:
+        """Store the scores of the digests and evict the least recently
+        used entries above the size bound"""
+        now = time.time()
+        self.db.executemany(
+            'INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?)',
+            [(digest, self.fingerprint,
+              np.asarray(score, dtype=np.float32).tobytes(), now)
+             for digest, score in zip(digests, scores)])
+        self.db.execute('DELETE FROM scores WHERE digest IN (SELECT digest '
+                        'FROM scores ORDER BY last_used DESC LIMIT -1 '
+                        'OFFSET ?)', (self.max_entries,))
+        self.db.commit()
+
+    def close(self) -> None:
+        self.db.close()
@@ -0,0 +1,16 @@
+import os
+import numpy as np
+
+
+def load_predictor(model_path: str, tflite_path: str = None):
+    """Return a function scoring a batch of uint8 images, with the TFLite
+    model if given, otherwise with the keras model.
+    Tensorflow is only imported for the keras model"""
+    if tflite_path:
+        from utils.lite_model import LiteModel
+        return LiteModel(tflite_path, threads=os.cpu_count()).predict
+
+    import tensorflow as tf
+    model = tf.keras.models.load_model(model_path)
+    return lambda images: np.asarray(
+        model(images.astype(np.float32), training=False))
@@ -0,0 +1,91 @@
+import os
+import csv
+import json
+import time
+import resource
+import numpy as np
+import tensorflow as tf
+
+
+class TrainingMonitor(tf.keras.callbacks.Callback):
+    """Keras callback recording the training throughput of every epoch.
+
+    The train dataset must go through instrument so the time a step
+    waits for its batch can be measured. Each epoch records the images
+    per second, the p50/p95 step latency, the fraction of the epoch
+    spent waiting on the input pipeline and the peak RSS of the process.
+    Results are written in metrics.json and metrics.csv in output_dir.
+    """
+    FIELDS = ['epoch', 'images', 'epoch_time', 'images_per_sec',
+              'step_p50_ms', 'step_p95_ms', 'input_wait_fraction',
+              'peak_rss_mb']
+
+    def __init__(self, output_dir: str):
+        super().__init__()
+        self.output_dir = output_dir
+        self.history = []
+        self.ready = []
+
+    def instrument(self, dataset: tf.data.Dataset) -> tf.data.Dataset:
+        """Stamp the time each batch is handed to the train step"""
+        def stamp(y):
+            self.ready.append((time.perf_counter(), len(y)))
+            return y
+
+        def mark(x, y):
+            marked = tf.numpy_function(stamp, [y], y.dtype)
+            marked.set_shape(y.shape)
+            return x, marked
+
+        return dataset.map(mark)
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.ready.clear()
+        self.begins, self.ends = [], []
+        self.epoch_start = time.perf_counter()
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.begins.append(time.perf_counter())
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.ends.append(time.perf_counter())
+
+    def on_epoch_end(self, epoch, logs=None):
+        steps = min(len(self.begins), len(self.ends), len(self.ready))
+        begins = np.array(self.begins[:steps])
+        ends = np.array(self.ends[:steps])
+        ready = np.array([t for t, _ in self.ready[:steps]])
+        images = sum(n for _, n in self.ready[:steps])
+
+        train_time = ends[-1] - self.epoch_start if steps else 0.0
+        step_ms = (ends - begins) * 1000
+        wait = np.clip(ready - begins, 0, None).sum()
+
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self.history.append({
+            'epoch': epoch + 1,
+            'images': int(images),
+            'epoch_time': round(float(time.perf_counter()
+                                      - self.epoch_start), 3),
+            'images_per_sec': round(images / train_time, 2)
+            if train_time else 0.0,
+            'step_p50_ms': round(float(np.percentile(step_ms, 50)), 3)
+            if steps else 0.0,
+            'step_p95_ms': round(float(np.percentile(step_ms, 95)), 3)
+            if steps else 0.0,
+            'input_wait_fraction': round(float(wait / train_time), 4)
+            if train_time else 0.0,
+            'peak_rss_mb': round(peak_rss / 1024, 1)
+        })
+        self.save()
+
+    def save(self):
+        """Write the metrics of all the epochs"""
+        os.makedirs(self.output_dir, exist_ok=True)
+        with open(os.path.join(self.output_dir, 'metrics.json'), 'w') as f:
+            json.dump(self.history, f, indent=2)
+        with open(os.path.join(self.output_dir, 'metrics.csv'), 'w',
+                  newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=self.FIELDS)
+            writer.writeheader()
+            writer.writerows(self.history)
@@ -0,0 +1,89 @@
+import os
+import json
+import random
+import numpy as np
+import tensorflow as tf
+
+
+STATE_DIR = 'state'
+STATE_MODEL = 'model.keras'
+STATE_FILE = 'state.json'
+
+
+def get_random_state() -> dict:
+    """Get the python and numpy global random states as json data"""
+    version, internal, gauss = random.getstate()
+    name, keys, pos, has_gauss, cached = np.random.get_state()
+    return {'python': [version, list(internal), gauss],
+            'numpy': [name, keys.tolist(), pos, has_gauss, cached]}
+
+
+def set_random_state(state: dict) -> None:
+    """Restore the random states saved by get_random_state"""
+    version, internal, gauss = state['python']
+    random.setstate((version, tuple(internal), gauss))
+    name, keys, pos, has_gauss, cached = state['numpy']
+    np.random.set_state((name, np.array(keys, dtype=np.uint32), pos,
+                         has_gauss, cached))
+
+
+def read_state(output_dir: str) -> dict:
+    """Read the training state saved in output_dir"""
+    state_path = os.path.join(output_dir, STATE_DIR, STATE_FILE)
+    if not os.path.isfile(state_path):
+        raise ValueError(f"No training state in {output_dir}")
+    with open(state_path) as f:
+        return json.load(f)
+
+
+def load_state_model(output_dir: str):
+    """Load the model saved with its compiled optimizer state"""
+    return tf.keras.models.load_model(
+        os.path.join(output_dir, STATE_DIR, STATE_MODEL))
+
+
+class TrainingState(tf.keras.callbacks.Callback):
+    """Keras callback saving at the end of every epoch everything needed
+    to resume the training: the model with its optimizer moments, the
+    epoch, the early stopping counters, the random states and the
+    options of the run (which hold the split file and the seed).
+
+    Given the state of an interrupted run, it restores the early
+    stopping counters when the training begins again. It must come
+    after early_stop in the callbacks list.
+    """
+    def __init__(self, output_dir: str, options: dict, early_stop,
+                 state: dict = None):
+        super().__init__()
+        self.state_dir = os.path.join(output_dir, STATE_DIR)
+        self.options = options
+        self.early_stop = early_stop
+        self.state = state
+
+    def on_train_begin(self, logs=None):
+        if self.state is None:
+            return
+        saved = self.state['early_stop']
+        self.early_stop.wait = saved['wait']
+        self.early_stop.best = saved['best']
+        self.early_stop.best_epoch = saved['best_epoch']
+        set_random_state(self.state['random'])
+
+    def on_epoch_end(self, epoch, logs=None):
+        os.makedirs(self.state_dir, exist_ok=True)
+        model_path = os.path.join(self.state_dir, STATE_MODEL)
+        self.model.save(model_path + '.tmp.keras')
+        os.replace(model_path + '.tmp.keras', model_path)
+
+        best = self.early_stop.best
+        state = {'epoch': epoch + 1,
+                 'early_stop': {'wait': self.early_stop.wait,
+                                'best': None if best is None
+                                else float(best),
+                                'best_epoch': self.early_stop.best_epoch},
+                 'random': get_random_state(),
+                 'options': self.options}
+        state_path = os.path.join(self.state_dir, STATE_FILE)
+        with open(state_path + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(state_path + '.tmp', state_path)
@@ -0,0 +1,143 @@
+from functools import cached_property
+
+from utils.data_transformation import imgt_lab, imgt_shadow_mask
+from utils.data_transformation import imgt_mask_background, imgt_mask_disease
+from utils.data_transformation import imgt_mask_background_fast
+from utils.data_transformation import imgt_mask_background_batch
+from utils.data_transformation import imgt_roi_mask
+from utils.data_transformation import imgt_downscale, imgt_upscale_mask
+from utils.mask_store import mask_model
+from utils.hashing import file_digest
+
+
+class TransformationContext:
+    """Intermediate masks of one image, shared by all its transformations.
+
+    Every node is computed the first time it is asked for and kept, so
+    the transformations only evaluate the part of the graph they need:
+
+        work_img -> lab -> shadow_mask -> background_mask
+            -> disease_mask -> roi_mask
+
+    The background mask comes from rembg in the 'quality' mode, from a
+    lab threshold in the 'fast' mode. Given the path of the image and a
+    MaskStore, it is read from the store, and computed then stored when
+    missing. The content hash of the file is computed once, unless given
+    as digest.
+
+    With a scale below 1, the masks are computed on the image resized by
+    scale (work_img), with the fill sizes scaled along, then upscaled to
+    the size of the image, their edges smoothed when refine is set.
+    """
+    def __init__(self, img, model_name: str = 'u2net',
+                 background_mode: str = 'quality',
+                 path: str = None, mask_store=None,
+                 scale: float = 1.0, refine: bool = False,
+                 digest: str = None):
+        self.img = img
+        self.model_name = model_name
+        self.background_mode = background_mode
+        self.path = path
+        self.mask_store = mask_store
+        self.scale = min(scale, 1.0)
+        self.refine = refine
+        if digest is not None:
+            self.digest = digest
+
+    @cached_property
+    def work_img(self):
+        """The image the masks are computed on"""
+        return imgt_downscale(self.img, self.scale)
+
+    @cached_property
+    def lab(self):
+        """The l, a and b channels of work_img"""
+        return imgt_lab(self.work_img)
+
+    @cached_property
+    def shadow_mask(self):
+        """The pixels lighter than the shadows in work_img"""
+        return imgt_shadow_mask(self.lab[0], self.scale)
+
+    @cached_property
+    def work_background_mask(self):
+        """The pixels of the leaf in work_img"""
+        mask = self.stored_background_mask()
+        if mask is None:
+            mask = self.compute_background_mask()
+            self.store_background_mask(mask)
+        return mask
+
+    @cached_property
+    def background_mask(self):
+        """The pixels of the leaf"""
+        return imgt_upscale_mask(self.work_background_mask, self.img.shape,
+                                 self.refine)
+
+    @cached_property
+    def digest(self):
+        """The content hash of the image file at path"""
+        return file_digest(self.path)
+
+    @cached_property
+    def mask_key(self):
+        """The key of the background mask in the mask store"""
+        return (self.digest,
+                mask_model(self.model_name, self.background_mode,
+                           self.scale))
+
+    def stored_background_mask(self):
+        if self.mask_store is None or self.path is None:
+            return None
+        return self.mask_store.get(*self.mask_key)
+
+    def store_background_mask(self, mask):
+        if self.mask_store is not None and self.path is not None:
+            self.mask_store.put(*self.mask_key, mask)
+
+    def compute_background_mask(self):
+        if self.background_mode == 'fast':
+            return imgt_mask_background_fast(self.work_img, self.shadow_mask,
+                                             self.lab, self.scale)
+        return imgt_mask_background(self.work_img, self.model_name,
+                                    self.shadow_mask)
+
+    @cached_property
+    def work_disease_mask(self):
+        """The pixels of the leaf out of the healthy colors in work_img"""
+        return imgt_mask_disease(self.work_img, self.work_background_mask)
+
+    @cached_property
+    def disease_mask(self):
+        """The pixels of the leaf out of the healthy colors"""
+        return imgt_upscale_mask(self.work_disease_mask, self.img.shape,
+                                 self.refine)
+
+    @cached_property
+    def roi_mask(self):
+        """The disease mask filtered by the region of interest"""
+        return imgt_roi_mask(self.disease_mask)
+
+
+def compute_background_masks(contexts: list) -> None:
+    """Compute the background masks of the contexts in the 'quality'
+    mode together, running rembg on them as one batch per model. The
+    masks found in the mask store are not computed again"""
+    missing = {}
+    for context in contexts:
+        if context.background_mode != 'quality' \
+                or 'work_background_mask' in context.__dict__:
+            continue
+        mask = context.stored_background_mask()
+        if mask is None:
+            missing.setdefault(context.model_name, []).append(context)
+        else:
+            context.work_background_mask = mask
+
+    for model_name, batch in missing.items():
+        masks = imgt_mask_background_batch(
+            [context.work_img for context in batch], model_name,
+            [context.shadow_mask for context in batch])
+        for context, mask in zip(batch, masks):
+            context.store_background_mask(mask)
+            context.work_background_mask = mask
@@ -0,0 +1,161 @@
+import numpy as np
+from PIL import Image, ImageDraw
+from matplotlib.colors import to_rgb
+from plantcv import plantcv as pcv
+
+from utils.data_transformation import imgt_gaussian_blur, imgt_leaf_mask
+from utils.data_transformation import imgt_roi, imgt_analyse
+from utils.data_transformation import imgt_x_pseudolandmarks
+from utils.data_transformation import imgt_y_pseudolandmarks
+from utils.data_transformation import imgt_color_histogram
+
+
+GRID_COLUMNS = 4
+TITLE_HEIGHT = 20
+MARGIN = 10
+LANDMARK_RADIUS = 3
+# Colors of the first, second and center pseudolandmarks
+LANDMARK_COLORS = ((253, 1, 255), (2, 34, 255), (255, 79, 0))
+HISTOGRAM_SIZE = (800, 400)
+
+TITLES = {
+    'background': 'Background mask',
+    'gaussian-blur': 'Gaussian Blur',
+    'mask': 'disease mask',
+    'roi': 'ROI',
+    'analyse': 'Analyse',
+    'pseudolandmarks-x': 'Pseudolandmarks X',
+    'pseudolandmarks-y': 'Pseudolandmarks Y',
+}
+
+
+def to_rgb8(img: np.ndarray) -> np.ndarray:
+    """Convert a mask, a float image or an rgba image to rgb uint8"""
+    img = np.asarray(img)
+    if img.dtype != np.uint8:
+        scale = 255 if img.max(initial=0) <= 1 else 1
+        img = np.clip(img * scale, 0, 255).astype(np.uint8)
+    if img.ndim == 2:
+        img = np.stack([img] * 3, axis=-1)
+    return img[..., :3]
+
+
+def draw_landmarks(img: np.ndarray, groups: tuple) -> np.ndarray:
+    """Draw the three groups of pseudolandmarks on a copy of img"""
+    panel = Image.fromarray(to_rgb8(img))
+    draw = ImageDraw.Draw(panel)
+    for points, color in zip(groups, LANDMARK_COLORS):
+        for point in points:
+            x, y = point[0][0], point[0][1]
+            draw.ellipse((x - LANDMARK_RADIUS, y - LANDMARK_RADIUS,
+                          x + LANDMARK_RADIUS, y + LANDMARK_RADIUS),
+                         fill=color)
+    return np.asarray(panel)
+
+
+def transformation_panel(img, context, transformation: str) -> np.ndarray:
+    """Compute the image shown for one transformation"""
+    if transformation == 'background':
+        return to_rgb8(context.background_mask)
+    if transformation == 'gaussian-blur':
+        return to_rgb8(imgt_gaussian_blur(context.disease_mask,
+                                          ksize=(7, 7)))
+    if transformation == 'mask':
+        return to_rgb8(imgt_leaf_mask(img, context.disease_mask))
+    if transformation == 'roi':
+        return to_rgb8(imgt_roi(img, context.disease_mask, context.roi_mask))
+    if transformation == 'analyse':
+        return to_rgb8(imgt_analyse(img, context.disease_mask,
+                                    context.roi_mask))
+    if transformation == 'pseudolandmarks-x':
+        top, bot, ctrv = imgt_x_pseudolandmarks(img, context.disease_mask,
+                                                context.roi_mask)
+        return draw_landmarks(img, (bot, top, ctrv))
+    if transformation == 'pseudolandmarks-y':
+        lft, rht, ctrh = imgt_y_pseudolandmarks(img, context.disease_mask,
+                                                context.roi_mask)
+        return draw_landmarks(img, (lft, rht, ctrh))
+    raise ValueError(f"Transformation {transformation} is not supported")
+
+
+def render_grid(panels: list) -> np.ndarray:
+    """Compose the (title, image) panels in a grid of GRID_COLUMNS
+    columns, with the title above each image"""
+    height = max(panel.shape[0] for _, panel in panels)
+    width = max(panel.shape[1] for _, panel in panels)
+    rows = (len(panels) + GRID_COLUMNS - 1) // GRID_COLUMNS
+    cell_h, cell_w = height + TITLE_HEIGHT + MARGIN, width + MARGIN
+    canvas = np.full((rows * cell_h + MARGIN, GRID_COLUMNS * cell_w + MARGIN,
+                      3), 255, dtype=np.uint8)
+    for i, (_, panel) in enumerate(panels):
+        y = (i // GRID_COLUMNS) * cell_h + MARGIN + TITLE_HEIGHT
+        x = (i % GRID_COLUMNS) * cell_w + MARGIN
+        canvas[y:y + panel.shape[0], x:x + panel.shape[1]] = panel
+
+    image = Image.fromarray(canvas)
+    draw = ImageDraw.Draw(image)
+    for i, (title, _) in enumerate(panels):
+        y = (i // GRID_COLUMNS) * cell_h + MARGIN + 4
+        x = (i % GRID_COLUMNS) * cell_w + MARGIN
+        draw.text((x, y), title, fill=(0, 0, 0))
+    return np.asarray(image)
+
+
+def render_histogram(c_hist: dict, all_freq) -> np.ndarray:
+    """Plot the color histograms of imgt_color_histogram as lines"""
+    width, height = HISTOGRAM_SIZE
+    left, right, top, bottom = 50, 20, 20, 40
+    plot_w, plot_h = width - left - right, height - top - bottom
+    y_max = max((max(y, default=0) for _, y, _ in c_hist.values()),
+                default=0)
+    y_max = y_max if np.isfinite(y_max) and y_max > 0 else 1
+
+    image = Image.new('RGB', HISTOGRAM_SIZE, (255, 255, 255))
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((left, top, left + plot_w, top + plot_h),
+                   outline=(0, 0, 0))
+    for tick in range(0, 256, 25):
+        x = left + tick * plot_w / 255
+        draw.line((x, top + plot_h, x, top + plot_h + 4), fill=(0, 0, 0))
+        draw.text((x - 8, top + plot_h + 6), str(tick), fill=(0, 0, 0))
+    for i in range(5):
+        value = y_max * i / 4
+        y = top + plot_h - value * plot_h / y_max
+        draw.line((left - 4, y, left, y), fill=(0, 0, 0))
+        draw.text((4, y - 6), f"{value:.1f}", fill=(0, 0, 0))
+    draw.text((left + plot_w // 2 - 40, height - 16), 'Pixel Intensity',
+              fill=(0, 0, 0))
+
+    for i, key in enumerate(all_freq):
+        x, y, color = c_hist[key]
+        color = tuple(int(255 * c) for c in to_rgb(color))
+        points = [(left + a * plot_w / 255, top + plot_h - b * plot_h / y_max)
+                  for a, b in zip(x, y) if np.isfinite(b)]
+        if len(points) > 1:
+            draw.line(points, fill=color, width=1)
+        draw.rectangle((left + 6, top + 6 + i * 14, left + 16,
+                        top + 14 + i * 14), fill=color)
+        draw.text((left + 20, top + 4 + i * 14), key, fill=(0, 0, 0))
+    return np.asarray(image)
+
+
+def save_transformation(img, context, transformation_list: list,
+                        color_histogram: bool, stem: str) -> None:
+    """Render the transformations of an image, and its color histogram,
+    into stem_transfo.png and stem_hist.png without matplotlib figures"""
+    try:
+        panels = [('Original', to_rgb8(img))]
+        for transformation in transformation_list:
+            panels.append((TITLES[transformation],
+                           transformation_panel(img, context,
+                                                transformation)))
+        Image.fromarray(render_grid(panels)).save(f"{stem}_transfo.png")
+
+        if color_histogram:
+            c_hist, all_freq = imgt_color_histogram(img,
+                                                    context.disease_mask,
+                                                    context.roi_mask)
+            Image.fromarray(render_histogram(c_hist, all_freq)).save(
+                f"{stem}_hist.png")
+    finally:
+        pcv.outputs.clear()